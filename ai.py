@@ -1,15 +1,61 @@
 import random
 from contextlib import contextmanager
+from typing import NamedTuple
 import operator
 
+import numpy as np
 import wasabi2d as w2d
 from wasabigeom import vec2
-from math import pi
+from math import pi, tau
 
 from collisions import colgroup
+import clocks
 from clocks import coro, animate
-from helpers import angle_to, random_ring
+from helpers import angle_to_pos, random_ring, positions
 import effects
+import flowfield
+from aiworker import worker
+
+
+# How often ships reconsider their targets, in seconds
+RETARGET_INTERVAL = 1.0
+
+# Ships further than this from a building they are attacking follow the
+# flow field rather than heading straight for it
+FLOW_RANGE = 300
+
+# Groups of at least this many coordinating ships fly in formation...
+SQUAD_MIN = 3
+# ...until they get this close to their target
+SQUAD_BREAK_RANGE = 600
+# If the ships get this far behind the formation, it waits for them
+SQUAD_REGROUP_RANGE = 200
+# Ships close on their formation slots over about this time, in seconds
+SQUAD_SLOT_EASE = 0.5
+
+# AI level of detail: ships further than this from every player viewport
+# update their AI at this interval, in seconds, rather than every frame
+LOD_TIERS = [
+    (1200, 0.25),
+    (300, 0.1),
+]
+
+
+class Formation(NamedTuple):
+    anchor: vec2
+    heading: vec2
+    speed: float
+
+
+# Offsets of ships in a formation, relative to its anchor and heading
+FORMATION_SLOTS = [
+    vec2(0, 0),
+    vec2(-60, -60),
+    vec2(-60, 60),
+    vec2(-120, -120),
+    vec2(-120, 120),
+    vec2(-180, 0),
+]
 
 
 class NullTarget:
@@ -34,29 +80,107 @@ class Group:
     """
 
     def __init__(self, groups=None):
-        self.other_groups = groups or set()
+        self.other_groups = set() if groups is None else groups
         self._base_target = None
         self._ship_target = None
         self.ships = 0
+        self.members = []
+        self.formation = None
+        self.merged_into = None
+
+    def live(self) -> 'Group':
+        """Get the group that this group's ships now belong to."""
+        group = self
+        while group.merged_into is not None:
+            group = group.merged_into
+        return group
 
     @contextmanager
-    def ship_alive(self):
-        self.ships += 1
+    def ship_alive(self, ship):
+        group = ship.groupctx = self.live()
+        group.ships += 1
+        ship.slot = len(group.members)
+        group.members.append(ship)
         try:
             yield
         finally:
-            self.ships -= 1
-            if self.ships == 0:
-                self.other_groups.discard(self)
-            elif self.ships == 1:
-                self.other_groups.discard(self)
-                if self.other_groups:
-                    merge_with = min(
-                        self.other_groups,
-                        key=operator.attrgetter('ships')
-                    )
-                    merge_with.ships += self.ships
-                    self.__dict__ = merge_with.__dict__
+            self.live()._ship_died(ship)
+
+    def _ship_died(self, ship):
+        self.ships -= 1
+        members = self.members
+        slot = next(i for i, m in enumerate(members) if m is ship)
+        del members[slot]
+        self._reslot(slot)
+        if self.ships == 0:
+            self.other_groups.discard(self)
+        elif self.ships == 1:
+            self.other_groups.discard(self)
+            if self.other_groups:
+                merge_with = min(
+                    self.other_groups,
+                    key=operator.attrgetter('ships')
+                )
+                merge_with.ships += self.ships
+                start = len(merge_with.members)
+                merge_with.members.extend(members)
+                merge_with._reslot(start)
+                for survivor in members:
+                    survivor.groupctx = merge_with
+                self.ships = 0
+                self.members = []
+                self.formation = None
+                self.merged_into = merge_with
+
+    def _reslot(self, start=0):
+        """Renumber the formation slots of members from start onwards."""
+        members = self.members
+        for i in range(start, len(members)):
+            members[i].slot = i
+
+    def update_squad(self, dt):
+        """Move the group's formation on towards the lead ship's target.
+
+        Groups that are too small, or close to their target, don't fly in
+        formation; the ships fall back to picking their own course.
+        """
+        members = self.members
+        if len(members) < SQUAD_MIN:
+            self.formation = None
+            return
+
+        target = members[0].target
+        centroid = vec2(*positions(members).mean(axis=0))
+        sep = target.pos - centroid
+        if target is NULL_TARGET \
+                or sep.length_squared() < SQUAD_BREAK_RANGE ** 2:
+            self.formation = None
+            return
+
+        heading = None
+        if target in colgroup.by_type['building']:
+            heading = flowfield.field.direction(centroid, target)
+        if heading is None:
+            heading = sep.scaled_to(1)
+
+        if self.formation is None \
+                or (self.formation.anchor - centroid).length_squared() \
+                > SQUAD_REGROUP_RANGE ** 2:
+            anchor = centroid
+        else:
+            anchor = self.formation.anchor
+        speed = min(ship.speed for ship in members)
+        self.formation = Formation(
+            anchor + heading * speed * dt, heading, speed
+        )
+
+    def waypoint(self, ship) -> 'vec2 | None':
+        """Get the ship's position in the formation, if flying in one."""
+        if self.formation is None:
+            return None
+        anchor, heading, _ = self.formation
+        slot = FORMATION_SLOTS[ship.slot % len(FORMATION_SLOTS)]
+        return anchor + slot.rotated(heading.angle())
 
     def get_ship_target(self):
         if not colgroup.by_type['ship']:
@@ -110,14 +234,185 @@ def pick_target(ship):
         ship.target = ship.groupctx.get_fighter_target(ship.pos)
 
 
-async def reconsider_target(ship):
-    """Periodically reconsider the ship's target."""
-    async for _ in coro.intervals(seconds=1):
-        pick_target(ship)
+def fighter_chance(ship) -> float:
+    """Get the probability that a ship picks a fighter target over the base."""
+    if ship.plan['ai'] not in ('attack', 'sniper'):
+        return 0.0
+    strength = ship.plan['strength']
+    return strength / (strength + 6)
 
 
-async def drive(ship):
+def solve_targets(positions, candidates, ship_idx, base_idx, chance, rolls):
+    """Choose targets for many ships at once.
+
+    positions is an (n, 2) array of ship positions and candidates an (m, 2)
+    array of target positions. ship_idx and base_idx index candidates with
+    each ship's group's ship and base targets, or are -1 if there is none.
+
+    Return an array of indexes into candidates, -1 for no target.
+    """
+    # Distances to each candidate, plus a column of inf for index -1
+    dist = np.full((len(positions), len(candidates) + 1), np.inf)
+    sep = positions[:, np.newaxis, :] - candidates[np.newaxis, :, :]
+    dist[:, :-1] = np.einsum('ijk,ijk->ij', sep, sep)
+
+    rows = np.arange(len(positions))
+    ship_dist = dist[rows, ship_idx]
+    base_dist = dist[rows, base_idx]
+    fighter_idx = np.where(ship_dist <= base_dist, ship_idx, base_idx)
+
+    attack_fighter = (rolls < chance) | (base_idx < 0)
+    return np.where(attack_fighter, fighter_idx, base_idx)
+
+
+def request_targets():
+    """Snapshot the ships and their candidate targets for the AI worker."""
+    ships = list(colgroup.by_type['threx'])
+    if not ships:
+        return
+
+    candidates = []
+    index = {NULL_TARGET: -1}
+
+    def target_idx(target):
+        try:
+            return index[target]
+        except KeyError:
+            i = index[target] = len(candidates)
+            candidates.append(target)
+            return i
+
+    group_targets = {}
+    ship_idx = np.empty(len(ships), dtype=int)
+    base_idx = np.empty(len(ships), dtype=int)
+    for i, ship in enumerate(ships):
+        group = ship.groupctx
+        try:
+            ship_t, base_t = group_targets[group]
+        except KeyError:
+            ship_t, base_t = group_targets[group] = (
+                target_idx(group.get_ship_target()),
+                target_idx(group.get_base_target()),
+            )
+        ship_idx[i] = ship_t
+        base_idx[i] = base_t
+
+    worker.submit(
+        'targets',
+        (ships, candidates),
+        solve_targets,
+        positions(ships),
+        positions(candidates),
+        ship_idx,
+        base_idx,
+        np.array([fighter_chance(ship) for ship in ships]),
+        np.random.random(len(ships)),
+    )
+
+
+def apply_targets(result):
+    """Assign the targets chosen by the AI worker."""
+    (ships, candidates), chosen = result
+    threx = colgroup.by_type['threx']
+    alive = colgroup.by_type['ship'] | colgroup.by_type['building']
+    for ship, i in zip(ships, chosen):
+        if ship not in threx:
+            continue
+        if i < 0:
+            ship.target = NULL_TARGET
+        elif candidates[i] in alive:
+            ship.target = candidates[i]
+
+
+async def run_targeting():
+    """Periodically reconsider the targets of all ships."""
+    due = clocks.game.t
+    async for _ in coro.frames():
+        result = worker.collect('targets')
+        if result:
+            apply_targets(result)
+        if clocks.game.t >= due:
+            due = clocks.game.t + RETARGET_INTERVAL
+            request_targets()
+
+
+def update_squads(dt):
+    """Move every group's formation on by dt."""
+    groups = {ship.groupctx for ship in colgroup.by_type['threx']}
+    for group in groups:
+        group.update_squad(dt)
+
+
+async def run_squads():
+    """Steer all formations, every frame."""
     async for dt in coro.frames_dt():
+        update_squads(dt)
+
+
+def course(ship, sep=None) -> vec2:
+    """Get the direction the ship should head in to reach its target.
+
+    sep is the separation to the point the ship wants to reach, if it is not
+    the target itself.
+    """
+    target = ship.target
+    if sep is None:
+        sep = target.pos - ship.pos
+    if sep.length_squared() > FLOW_RANGE ** 2 \
+            and target in colgroup.by_type['building']:
+        d = flowfield.field.direction(ship.pos, target)
+        if d is not None:
+            return d
+    return sep
+
+
+def velocity(ship, sep=None) -> vec2:
+    """Get the velocity the ship should fly at to follow its course.
+
+    Ships in formation fly with it, closing on their slot and easing off as
+    they reach it; other ships fly flat out.
+    """
+    group = ship.groupctx
+    waypoint = group.waypoint(ship)
+    if waypoint is None:
+        return course(ship, sep).scaled_to(ship.speed)
+
+    formation = group.formation
+    v = formation.heading * formation.speed \
+        + (waypoint - ship.pos) / SQUAD_SLOT_EASE
+    if v.length_squared() > ship.speed ** 2:
+        return v.scaled_to(ship.speed)
+    return v
+
+
+def lod_interval(ship) -> float:
+    """Get how often the ship's AI should update; 0 for every frame."""
+    distance = effects.view_distance(ship.pos)
+    for min_distance, interval in LOD_TIERS:
+        if distance > min_distance:
+            return interval
+    return 0
+
+
+async def lod_frames(ship):
+    """Like coro.frames_dt(), but less often for ships far from any player.
+
+    Each iteration yields the game time since the last.
+    """
+    t = clocks.game.t
+    while True:
+        interval = lod_interval(ship)
+        if interval:
+            await coro.sleep(interval)
+        else:
+            await coro.next_frame()
+        now = clocks.game.t
+        yield now - t
+        t = now
+
+
+async def drive(ship):
+    async for dt in lod_frames(ship):
         ship.vel = ship.vel.rotated(ship.rudder * ship.turn_rate * dt)
 
         ship.pos += ship.vel * dt
@@ -125,13 +420,15 @@ async def drive(ship):
 
 
 async def steer(ship):
-    async for dt in coro.frames_dt():
+    async for dt in lod_frames(ship):
         target = ship.target
-        r = angle_to(target, ship)
+        v = velocity(ship)
+        r = angle_to_pos(ship.pos + v, ship)
 
         if abs(r) > pi / 2:
             await coro.sleep(0.4)
-            r = angle_to(target, ship)
+            v = velocity(ship)
+            r = angle_to_pos(ship.pos + v, ship)
 
         if r > 1e-2:
             ship.rudder = 1
@@ -139,6 +436,8 @@ async def steer(ship):
             ship.rudder = -1
         else:
             ship.rudder = 0
+        # Keep station in formation, but keep enough speed to turn
+        ship.vel = ship.vel.scaled_to(max(v.length(), ship.speed * 0.25))
 
         if abs(r) > pi / 2:
             await coro.sleep(0.2)
@@ -149,6 +448,81 @@ async def steer(ship):
             await coro.sleep(0.2)
 
 
+def solve_firing(positions, angles, target_positions, ranges, accuracies):
+    """Check which ships can fire at their targets.
+
+    Ships can fire if their target is within range and they are pointing at
+    it to within their accuracy. Return a boolean array.
+    """
+    sep = target_positions - positions
+    dist2 = np.einsum('ij,ij->i', sep, sep)
+    bearing = np.arctan2(sep[:, 1], sep[:, 0])
+    off_target = (bearing - angles + pi) % tau - pi
+    return (dist2 < ranges ** 2) & (np.abs(off_target) < accuracies)
+
+
+class FiringSolutions:
+    """Batch up the checks for when ships can fire.
+
+    Ships wait in aim(). Each frame, solve() snapshots every waiting ship
+    for the AI worker, and wakes those that the previous snapshot found can
+    fire.
+    """
+
+    def __init__(self):
+        self.waiting = {}
+
+    async def aim(self, ship, attack_range, accuracy):
+        """Wait until the ship's target is in range and in its sights."""
+        event = w2d.Event()
+        self.waiting[ship] = attack_range, accuracy, event
+        try:
+            await event
+        finally:
+            self.waiting.pop(ship, None)
+
+    def solve(self):
+        """Wake the ships that can fire, and request the next solutions."""
+        result = worker.collect('firing')
+        if result:
+            (ships, targets), can_fire = result
+            for i in np.flatnonzero(can_fire):
+                ship = ships[i]
+                if ship not in self.waiting or ship.target is not targets[i]:
+                    continue
+                if ship.plan['ai'] == 'sniper' and not colgroup.line_of_sight(
+                        ship.pos, ship.target.pos, ignore={ship.target}):
+                    # Don't waste long range shots on the base
+                    continue
+                *_, event = self.waiting.pop(ship)
+                event.set()
+
+        if not self.waiting:
+            return
+        ships = list(self.waiting)
+        targets = [ship.target for ship in ships]
+        ranges, accuracies, _ = zip(*self.waiting.values())
+        worker.submit(
+            'firing',
+            (ships, targets),
+            solve_firing,
+            positions(ships),
+            np.array([ship.angle for ship in ships]),
+            positions(targets),
+            np.array(ranges),
+            np.array(accuracies),
+        )
+
+
+firing = FiringSolutions()
+
+
+async def run_firing():
+    """Check firing solutions for all waiting ships, every frame."""
+    async for _ in coro.frames():
+        firing.solve()
+
+
 async def shoot(ship, fire_weapon):
     attack_range = 1000 if ship.plan['ai'] == 'sniper' else 400
 
@@ -159,12 +533,8 @@ async def shoot(ship, fire_weapon):
     accuracy = 0.05 + 0.5 / (1 + ship.plan['strength'])
 
     while True:
-        async for dt in coro.frames_dt():
-            target = ship.target
-            dist = (target.pos - ship.pos).length()
-            if dist < attack_range and abs(angle_to(target, ship)) < accuracy:
-                break
-            await coro.sleep(0.1)
+        await firing.aim(ship, attack_range, accuracy)
+        target = ship.target
         if target is NULL_TARGET:
             await coro.sleep(1)
             continue
@@ -177,14 +547,18 @@ async def shoot(ship, fire_weapon):
 
 async def drive_kamikaze(ship):
     while True:
-        async for dt in coro.frames_dt():
+        async for dt in lod_frames(ship):
             target = ship.target
             sep = target.pos - ship.pos
-            if target is not NULL_TARGET \
-                and sep.length_squared() < target.radius ** 2 + ship.radius ** 2:
+            # Far away ships move in big steps; don't step over the target
+            reach = max(
+                target.radius ** 2 + ship.radius ** 2,
+                (ship.speed * dt) ** 2
+            )
+            if target is not NULL_TARGET and sep.length_squared() < reach:
                 break
-            ship.angle = sep.angle()
-            ship.vel = sep.scaled_to(ship.speed)
+            ship.vel = velocity(ship, sep)
+            ship.angle = ship.vel.angle()
             ship.pos += ship.vel * dt
 
         if target in colgroup.by_type['building']:
@@ -228,16 +602,16 @@ async def zapper(ship, weapon_func):
     ship.weapon_interval *= 0.7
 
     async def move_to_firing_pos():
-        async for dt in coro.frames_dt():
+        async for dt in lod_frames(ship):
             if ship.target is not target:
                 return False
             firing_pos = target.pos - (target.pos - ship.pos).scaled_to(200)
 
             sep = firing_pos - ship.pos
-            if sep.length_squared() < 50:
+            if sep.length_squared() < max(50, (ship.speed * dt) ** 2):
                 return True
-            ship.angle = sep.angle()
-            ship.vel = sep.scaled_to(ship.speed)
+            ship.vel = velocity(ship, sep)
+            ship.angle = ship.vel.angle()
             ship.pos += ship.vel * dt
 
     while True:
@@ -0,0 +1,60 @@
+"""Run AI decisions on a worker thread.
+
+The game thread takes a compact snapshot of the world - mostly numpy arrays
+of positions - and submits it along with a pure function to compute from it.
+The worker publishes the results, and the game thread collects and applies
+them on a later frame, so that a heavy AI tick doesn't stall rendering.
+
+Results can be a frame or so stale, so whoever applies them must check that
+they still make sense (eg. that the ship is still alive).
+"""
+import sys
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# On free-threaded Python, jobs can really run in parallel
+FREE_THREADED = not getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+class Worker:
+    """Compute AI jobs in the background.
+
+    There is at most one job in flight per name; the game thread submits the
+    next snapshot once it has collected the previous result.
+    """
+
+    def __init__(self, threads: int = 1):
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads,
+            thread_name_prefix='ai',
+        )
+        self.jobs: dict[str, tuple[object, Future]] = {}
+
+    def submit(self, name: str, context, func, *args) -> bool:
+        """Start computing func(*args) in the background.
+
+        context is handed back with the result; it is for the game thread
+        and is not passed to func.
+
+        Return False if the previous job of this name is still pending.
+        """
+        if name in self.jobs:
+            return False
+        self.jobs[name] = context, self.executor.submit(func, *args)
+        return True
+
+    def collect(self, name: str):
+        """Get the (context, result) of a finished job, or None if not ready.
+
+        Each result is only collected once.
+        """
+        try:
+            context, future = self.jobs[name]
+        except KeyError:
+            return None
+        if not future.done():
+            return None
+        del self.jobs[name]
+        return context, future.result()
+
+
+worker = Worker(threads=3 if FREE_THREADED else 1)
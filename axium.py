@@ -1,17 +1,19 @@
 import wasabi2d as w2d
 from wasabigeom import vec2
 import numpy as np
-import pygame
-import pygame.mixer
 import random
 from math import tau, pi, sin, cos
-from itertools import count, cycle
+from itertools import count
 from contextlib import asynccontextmanager, contextmanager
 from dataclasses import dataclass
+from collections import deque, defaultdict
+from functools import partial
+from typing import Callable
+from pathlib import Path
 
 import sfx
 import building
-from helpers import showing, random_ring, angle_to
+from helpers import showing, random_ring
 from collisions import colgroup
 import controllers
 from clocks import coro, animate
@@ -19,12 +21,16 @@ import clocks
 import effects
 import waves
 import ai
+import snapshot
+from guidance import guidance, run_guidance
+from timeline import run_timelines
 
 # Ship deceleration
 DECEL = 0.01
 ACCEL = 2000
 BULLET_SPEED = 700  # px/s
 ROCKET_SPEED = 400  # px/s
+SPAWNS_PER_FRAME = 3  # Threx to create/bring to life per frame
 
 scene = building.scene = w2d.Scene(1280, 720, title="Axium", fullscreen=True)
 #scene.chain = [w2d.chain.LayerRange().wrap_effect('pixellate', pxsize=4, antialias=0.5)]
@@ -45,7 +51,7 @@ hudvp = scene.create_viewport()
 hud = hudvp.layers[5]
 radar_layer = hudvp.layers[0]
 
-effects.init(scene)
+effects.init(scene, hudvp)
 
 # The set of objects the Threx would like to attack
 targets = set()
@@ -64,7 +70,8 @@ def kill_ship(ship):
 
 
 def kill_threx(threx):
-    effects.pixels.emit(
+    effects.emit(
+        effects.pixels,
         10,
         pos=threx.pos,
         vel=threx.vel,
@@ -86,14 +93,15 @@ def handle_collision(ship, threx):
 
 
 @colgroup.handler('threx', 'bullet')
-def handle_collision(threx, bullet):
+def hit_threx(threx, bullet):
     threx.health -= bullet.damage
     if threx.health <= 0:
         kill_threx(threx)
         for _ in range(random.randint(1, 3)):
             game.do(building.star_bit(threx.pos))
     else:
-        effects.pixels.emit(
+        effects.emit(
+            effects.pixels,
             5,
             pos=threx.pos,
             vel=bullet.vel * 0.3,
@@ -148,7 +156,29 @@ async def phaser(ship):
     shot.radius = 22
     shot.damage = 15
     shot.fragile = False
-    await shoot(shot, ship)
+    await shoot_piercing(shot, ship)
+
+
+async def shoot_piercing(shot, shooter, offset=vec2(20, 0), max_age=3):
+    """Fire a shot that can pass through several Threx.
+
+    Rather than tracking the shot for collisions, each frame we find every
+    Threx along the path the shot moved through, and hit them in order.
+    """
+    vel = vec2(BULLET_SPEED, 0).rotated(shooter.angle) + shooter.vel
+    shot.pos = shooter.pos + offset.rotated(shooter.angle)
+    shot.angle = shooter.angle
+    shot.vel = vel
+    with showing(shot):
+        async for dt in coro.frames_dt(seconds=max_age):
+            start = shot.pos
+            end = shot.pos = start + vel * dt
+            hits = colgroup.segment_cast(start, end, 'threx', shot.radius)
+            for _, threx in hits:
+                hit_threx(threx, shot)
+                if not shot:
+                    # Stopped by a Threx that survived
+                    return
 
 
 async def rocket(ship):
@@ -176,36 +206,19 @@ async def rocket(ship):
     shot.fragile = True
     shot.vel = vel
 
-    target = None
-
-    with colgroup.tracking(shot, 'bullet'), showing(shot):
+    with colgroup.tracking(shot, 'bullet'), showing(shot), \
+            guidance.guiding(shot):
         async for dt in coro.frames_dt(seconds=2):
-            if not target or not target.is_alive():
-                target = None
-                objs = colgroup.test(shot.pos, 200, 'threx')
-                if objs:
-                    target = objs[0]
-
-            if target:
-                r = angle_to(target, shot)
-
-                if r > 1e-2:
-                    vel = vel.rotated(min(r, 10 * dt))
-                elif r < -1e-2:
-                    vel = vel.rotated(max(r, -10 * dt))
-                shot.angle = vel.angle()
-
             if not shot:
                 break
-            shot.pos += vel * dt
-            shot.vel = vel
+            shot.pos += shot.vel * dt
     effects.explode(shot.pos, vec2(0, 0))
 
 
-async def threx_shoot(ship):
+async def threx_shoot(ship, offset=vec2(20, 0)):
     sfx.enemy_laser.play()
     vel = vec2(BULLET_SPEED, 0).rotated(ship.angle) + ship.vel
-    pos = ship.pos + vec2(20, 0).rotated(ship.angle)
+    pos = ship.pos + offset.rotated(ship.angle)
     shot = w2d.Group(
         [
             scene.layers[1].add_sprite('threx_bullet1'),
@@ -226,6 +239,18 @@ async def threx_shoot(ship):
             shot[1].angle -= 2 * dt
 
 
+async def threx_phaser(ship, offset):
+    shot = w2d.Group(
+        [
+            scene.layers[1].add_sprite('threx_phaser', pos=(-5, 0)),
+            effects.mklight(color='red'),
+        ]
+    )
+    shot.radius = 8
+    shot.damage = 5
+    await shoot(shot, ship, offset=offset, type='threx_bullet', max_age=1)
+
+
 async def threx_bomb(ship, offset):
     sfx.enemy_laser.play()
     vel = vec2(BULLET_SPEED, 0).rotated(ship.angle) + ship.vel
@@ -248,85 +273,181 @@ async def threx_bomb(ship, offset):
     shot.vel = vel
     shot.radius = 12
     shot.damage = 15
+    smoke = shot[3]
     with colgroup.tracking(shot, 'threx_bullet'), showing(shot):
         async for dt in coro.frames_dt(seconds=3):
             if not shot:
                 break
             shot.pos += vel * dt
+            smoke.rate = 70 if effects.visible(shot.pos) else 0
             shot[0].angle += 4 * dt
             shot[1].angle -= 2 * dt
 
 
-async def do_threx(bullet_nursery, pos, ship_plan, groupctx):
-    """Coroutine to run an enemy ship."""
-
-    trailpos = vec2(-10, 0)
-    if ship_plan['type'] == 'fighter':
-        ship = scene.layers[0].add_sprite('threx', pos=pos)
-        ship.radius = 14
-        ship.speed = 250
-        ship.weapon_interval = 1.0
-        ship.health = 10
-        ship.turn_rate = 3.0
-        trailpos = vec2(-6, 0)
-
-        def weapon_func():
-            bullet_nursery.do(threx_shoot(ship))
-    elif ship_plan['type'] == 'interceptor':
-        ship = scene.layers[0].add_sprite('threx_interceptor', pos=pos)
-        ship.radius = 18
-        ship.speed = 350
-        ship.health = 10 + ship_plan['strength'] // 10 * 10
-        ship.weapon_interval = 0.5
-        ship.turn_rate = 2.0
-        def weapon_func():
-            for port in (vec2(0, -15), vec2(0, 15)):
-                shot = w2d.Group(
-                    [
-                        scene.layers[1].add_sprite('threx_phaser', pos=(-5, 0)),
-                        effects.mklight(color='red'),
-                    ]
-                )
-                shot.radius = 8
-                shot.damage = 5
-                bullet_nursery.do(shoot(
-                    shot,
-                    ship,
-                    offset=port,
-                    type='threx_bullet',
-                    max_age=1
-                ))
-    elif ship_plan['type'] == 'bomber':
-        ship = scene.layers[0].add_sprite('threx_bomber', pos=pos)
-        ship.radius = 30
-        ship.speed = 150
-        ship.health = 40 + ship_plan['strength'] // 5 * 10
-        ship.weapon_interval = 1.0
-        ship.turn_rate = 1.0
-        ports = cycle([vec2(10, -25), vec2(10, 25)])
-        def weapon_func():
-            port = next(ports)
-            bullet_nursery.do(threx_bomb(ship, port))
-    else:
-        raise ValueError(f"Unknown ship type {ship_plan['type']}")
+@dataclass(frozen=True)
+class Archetype:
+    """The stats and weapon of a type of Threx ship."""
+
+    sprite: str
+    radius: float
+    speed: float
+    turn_rate: float
+    health: int
+
+    #: Coroutine function weapon(ship, offset) to fire one shot
+    weapon: Callable
+    weapon_interval: float
+
+    #: Gun ports to fire from, relative to the ship
+    ports: tuple[vec2, ...] = (vec2(20, 0),)
+
+    #: If True fire all ports at once, else alternate between them
+    salvo: bool = False
+
+    #: Gain 10 health per this much strength (0 for no extra health)
+    armour_per_strength: int = 0
+
+    trailpos: vec2 = vec2(-10, 0)
+    big_explosion: bool = False
+
+    def health_for(self, strength: int) -> int:
+        """Get the starting health of a ship with the given strength."""
+        if not self.armour_per_strength:
+            return self.health
+        return self.health + strength // self.armour_per_strength * 10
+
 
+THREX_TYPES = {
+    'fighter': Archetype(
+        sprite='threx',
+        radius=14,
+        speed=250,
+        turn_rate=3.0,
+        health=10,
+        weapon=threx_shoot,
+        weapon_interval=1.0,
+        trailpos=vec2(-6, 0),
+    ),
+    'interceptor': Archetype(
+        sprite='threx_interceptor',
+        radius=18,
+        speed=350,
+        turn_rate=2.0,
+        health=10,
+        armour_per_strength=10,
+        weapon=threx_phaser,
+        weapon_interval=0.5,
+        ports=(vec2(0, -15), vec2(0, 15)),
+        salvo=True,
+    ),
+    'bomber': Archetype(
+        sprite='threx_bomber',
+        radius=30,
+        speed=150,
+        turn_rate=1.0,
+        health=40,
+        armour_per_strength=5,
+        weapon=threx_bomb,
+        weapon_interval=1.0,
+        ports=(vec2(10, -25), vec2(10, 25)),
+        big_explosion=True,
+    ),
+}
+
+
+class ShipPool:
+    """Recycle enemy ship sprites rather than creating them for each ship.
+
+    Sprites in the pool are kept in the scene, but invisible.
+    """
+
+    def __init__(self):
+        self.free: dict[str, list] = defaultdict(list)
+
+    def checkout(self, archetype: Archetype, pos: vec2):
+        """Get an invisible sprite for a ship of the given archetype."""
+        free = self.free[archetype.sprite]
+        if free:
+            ship = free.pop()
+            ship.pos = pos
+            ship.angle = 0
+        else:
+            ship = scene.layers[0].add_sprite(archetype.sprite, pos=pos)
+        ship.color = (1, 1, 1, 0)
+        return ship
+
+    def release(self, ship):
+        """Return a ship's sprite to the pool."""
+        ship.color = (1, 1, 1, 0)
+        self.free[ship.archetype.sprite].append(ship)
+
+    @contextmanager
+    def using(self, ship):
+        """Release a ship's sprite back to the pool after the context."""
+        try:
+            yield ship
+        finally:
+            self.release(ship)
+
+
+ship_pool = ShipPool()
+
+
+def fire_threx_weapon(ship):
+    """Fire a ship's weapon from the next gun port(s)."""
+    archetype = ship.archetype
+    ports = archetype.ports
+    if not archetype.salvo:
+        ports = ports[ship.shots_fired % len(ports)],
+    ship.shots_fired += 1
+    for port in ports:
+        game.do(archetype.weapon(ship, port))
+
+
+def prepare_threx(pos, ship_plan):
+    """Set up an enemy ship, ready to be spawned.
+
+    The ship is invisible until it is brought to life with do_threx().
+    """
+    try:
+        archetype = THREX_TYPES[ship_plan['type']]
+    except KeyError:
+        raise ValueError(f"Unknown ship type {ship_plan['type']}") from None
+
+    ship = ship_pool.checkout(archetype, pos)
+    ship.archetype = archetype
+    ship.plan = ship_plan
+    ship.radius = archetype.radius
+    ship.speed = archetype.speed
+    ship.turn_rate = archetype.turn_rate
+    ship.health = archetype.health_for(ship_plan['strength'])
+    ship.weapon_interval = archetype.weapon_interval
+    ship.weapon_func = partial(fire_threx_weapon, ship)
+    ship.shots_fired = 0
+    ship.trail = effects.mktrail(pos, color='red', stroke_width=1)
+    return ship
+
+
+async def do_threx(ship, groupctx):
+    """Coroutine to run an enemy ship prepared with prepare_threx()."""
+    ship.color = (1, 1, 1, 1)
     ship.vel = vec2(ship.speed, 0)
     ship.rudder = 0
-    ship.plan = ship_plan
 
     if not ship.plan['group_aware']:
         groupctx = ai.Group()
-    ship.groupctx = groupctx
+    ship.groupctx = groupctx.live()
 
     ai.pick_target(ship)
-    with colgroup.tracking(ship, 'threx'), showing(ship), groupctx.ship_alive():
+    trailpos = ship.archetype.trailpos
+    with colgroup.tracking(ship, 'threx'), ship_pool.using(ship), \
+            groupctx.ship_alive(ship):
         async with w2d.Nursery() as ns:
             ship.nursery = ns
-            ns.do(ai.reconsider_target(ship))
-            ns.do(getattr(ai, ship.plan['ai'])(ship, weapon_func))
-            ns.do(effects.trail(ship, color='red', stroke_width=1, relpos=trailpos))
+            ns.do(getattr(ai, ship.plan['ai'])(ship, ship.weapon_func))
+            ns.do(effects.trail(ship, relpos=trailpos, line=ship.trail))
 
-    if ship_plan['type'] == 'bomber':
+    if ship.archetype.big_explosion:
         effects.explode(ship.pos, vec2(0, 0))
         sfx.explosion.play()
     else:
@@ -520,19 +641,40 @@ async def show_title(text):
     label.delete()
 
 
+async def announce_wave(wave_num):
+    await sfx.announcer.announce(wave_num)
+
+
+async def prepare_wave(groups, spawns):
+    """Prepare the ships of a wave, a few per frame, appending to spawns."""
+    for plan, groupctx in zip(groups, ai.mkgroups(len(groups))):
+        group_center = random_ring(1500)
+        for ship_plan in plan:
+            pos = group_center + random_ring(100)
+            spawns.append((prepare_threx(pos, ship_plan), groupctx))
+            if len(spawns) % SPAWNS_PER_FRAME == 0:
+                await coro.next_frame()
+
+
 async def wave(wave_num, groups=None):
-    async with show_title(f"Beginning wave {wave_num}"):
-        await sfx.play('beginning_wave')
-        for sound in sfx.spell(wave_num):
-            await sfx.play(sound)
-
-    async with w2d.Nursery() as ns:
-        groups = groups or waves.plan_ships_of_wave(wave_num)
-        for plan, groupctx in zip(groups, ai.mkgroups(len(groups))):
-            group_center = random_ring(1500)
-            for ship_plan in plan:
-                pos = group_center + random_ring(100)
-                ns.do(do_threx(game, pos, ship_plan, groupctx))
+    groups = groups or waves.plan_ships_of_wave(wave_num)
+    spawns = deque()
+    try:
+        async with show_title(f"Beginning wave {wave_num}"):
+            async with w2d.Nursery() as ns:
+                ns.do(announce_wave(wave_num))
+                ns.do(prepare_wave(groups, spawns))
+
+        async with w2d.Nursery() as ns:
+            while spawns:
+                for _ in range(min(SPAWNS_PER_FRAME, len(spawns))):
+                    ns.do(do_threx(*spawns.popleft()))
+                await coro.next_frame()
+    finally:
+        # Clean up ships that were prepared but never spawned
+        for ship, _ in spawns:
+            ship.trail.delete()
+            ship_pool.release(ship)
     await slowmo()
 
 
@@ -602,8 +744,9 @@ class Balance:
         self.sprite.delete()
 
 
-async def play_game(nursery):
-    lives = 5
+async def play_game(nursery, restore=None):
+    global lives, balance
+    lives = restore.lives if restore else 5
 
     pos = vec2(20, 20)
     icons = [
@@ -614,11 +757,15 @@ async def play_game(nursery):
         )
         for i in range(lives)
     ]
-    balance = Balance()
-    nursery.do(building.base.place(building.Reactor, vec2(0, 100)))
+    if restore:
+        balance = Balance(restore.balance)
+        nursery.do(building.base.restore(restore.layout))
+    else:
+        balance = Balance()
+        nursery.do(building.base.place(building.Reactor, vec2(0, 100)))
 
     def take_life():
-        nonlocal lives
+        global lives
         if not lives:
             return False
         lives -= 1
@@ -673,7 +820,7 @@ async def play_game(nursery):
                 hotplug.do(wait_for_p2())
 
     building.base.clear()
-    w2d.sounds.game_over.play()
+    sfx.say('game_over')
     nursery.cancel()
 
 
@@ -736,21 +883,49 @@ async def main():
         help="Walk through enemy ship combos",
         default=False
     )
+    p.add_argument(
+        '--no-audio',
+        action='store_true',
+        help="Run without sound or music",
+        default=False
+    )
+    p.add_argument(
+        '--restore',
+        metavar='FILE',
+        help="Start from a snapshot saved with --save-snapshots",
+    )
+    p.add_argument(
+        '--save-snapshots',
+        metavar='DIR',
+        help="Save a snapshot of the game at the end of each wave",
+    )
     args = p.parse_args()
 
     Balance.INITIAL_BALANCE = args.cash or 0
+    restore = snapshot.load(args.restore) if args.restore else None
+    start_wave = restore.wave if restore else args.wave
+    if args.save_snapshots:
+        snapshot_dir = Path(args.save_snapshots)
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
 
     global game
     async with w2d.Nursery() as services:
         services.do(controllers.hotplug())
+        if not args.no_audio:
+            services.do(sfx.init())
         while True:
             stick = await title()
             async with w2d.Nursery() as game:
                 effects.game = game
-                game.do(play_game(game))
+                game.do(play_game(game, restore))
                 game.do(screenshot(controllers.sticks[0]))
                 game.do(collisions())
-                if args.wave != 1:
+                game.do(ai.run_targeting())
+                game.do(ai.run_firing())
+                game.do(ai.run_squads())
+                game.do(run_guidance())
+                game.do(run_timelines())
+                if start_wave != 1:
                     # FIXME: this causes a crash for some reason?
                     # File "wasabi2d/primitives/text.py", line 34, in render
                     #     self.tex.use(0)
@@ -761,11 +936,21 @@ async def main():
                     # async with title("Get ready!"):
                     #     await coro.sleep(20)
                     await coro.sleep(5)
-                for wave_num in count(args.wave):
+                if restore:
+                    snapshot.restore_rng(restore)
+                for wave_num in count(start_wave):
                     if args.test_threx:
                         await wave(wave_num, waves.test_ship_type(wave_num))
                     else:
                         await wave(wave_num)
+                    if args.save_snapshots:
+                        snap = snapshot.take(
+                            wave_num + 1, lives, int(balance.value)
+                        )
+                        snapshot.save(
+                            snapshot_dir / f'wave{wave_num + 1:03d}.axs',
+                            snap
+                        )
         services.cancel()
 
 
@@ -1,8 +1,10 @@
-from typing import Type, TypeVar, NamedTuple
+from typing import Type, TypeVar, NamedTuple, Iterable
 from itertools import product, count
 from enum import Enum
 import math
-from collections import Counter, deque
+import heapq
+from collections import Counter, deque, defaultdict
+from contextlib import contextmanager
 
 import numpy as np
 import wasabi2d as w2d
@@ -15,6 +17,7 @@ from collisions import colgroup
 import clocks
 from clocks import coro, animate
 import effects
+from timeline import Track, Timeline, play
 
 scene: w2d.Scene = None
 diffuse = -2
@@ -22,6 +25,51 @@ emissive = -1
 
 LIGHTBLUE = (0.6, 0.6, 1.0, 1.0)
 WHITE = (1.0, 1.0, 1.0, 1.0)
+BLACK = (0.0, 0.0, 0.0, 1.0)
+
+# Each armory light blinks this many times before it comes on
+BLINKS = 5
+RADAR_SWEEPS = 8
+
+IRIS_CYCLE = Track(
+    [(0, 0.01), (0.1, 1.0), (1.1, 1.0), (1.2, 0.01)],
+    tween='decelerate',
+)
+IRIS_OPENED = 0.1
+IRIS_CLOSING = 1.1
+
+
+def charge_lights(lights) -> Timeline:
+    """Blink each light in turn, then leave them all on."""
+    tracks = []
+    for i, light in enumerate(lights):
+        start = i * (BLINKS + 0.5)
+        keyframes = [(0, BLACK), (start, BLACK)]
+        for b in range(BLINKS):
+            keyframes += [
+                (start + b + 0.5, LIGHTBLUE),
+                (start + b + 1, BLACK),
+            ]
+        keyframes.append((start + BLINKS + 0.5, LIGHTBLUE))
+        tracks.append((light, 'color', Track(keyframes)))
+    return Timeline(tracks)
+
+
+def radar_sweep(radar) -> Timeline:
+    """Turn the radar to a random heading every few seconds, forever."""
+    keyframes = []
+    angle = start_angle = radar.angle
+    for i in range(RADAR_SWEEPS):
+        t = i * 4
+        keyframes.append((t, angle))
+        if i == RADAR_SWEEPS - 1:
+            angle = start_angle
+        else:
+            angle = start_angle + random.uniform(-1, 1)
+        keyframes.append((t + 1, angle))
+    keyframes.append((RADAR_SWEEPS * 4, start_angle))
+    track = Track(keyframes, tween='accel_decel', loop=True)
+    return Timeline([(radar, 'angle', track)])
 
 
 @colgroup.handler('ship', 'star_bit')
@@ -82,6 +130,344 @@ def manhattan_distance(a: tuple[int, int], b: tuple[int, int]):
     return abs(ax - bx) + abs(ay - by)
 
 
+class ConnectorIndex:
+    """The connector cells of the base, indexed for nearest-cell queries.
+
+    Cells are bucketed into square blocks so that we only need to search
+    blocks close to the query cell. A cell can be a connector of more than
+    one building, so we count how many times each cell was added.
+    """
+
+    BLOCK = 8  # cells along each side of a block
+
+    def __init__(self):
+        self.counts: Counter[tuple[int, int]] = Counter()
+        self.blocks: dict[tuple[int, int], set] = defaultdict(set)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __contains__(self, cell):
+        return cell in self.counts
+
+    def _block(self, cell: tuple[int, int]) -> tuple[int, int]:
+        x, y = cell
+        return x // self.BLOCK, y // self.BLOCK
+
+    def update(self, cells: Iterable[tuple[int, int]]):
+        """Add connector cells."""
+        for cell in cells:
+            self.counts[cell] += 1
+            self.blocks[self._block(cell)].add(cell)
+
+    def remove(self, cells: Iterable[tuple[int, int]]):
+        """Remove connector cells (once each)."""
+        for cell in cells:
+            count = self.counts.get(cell, 0) - 1
+            if count > 0:
+                self.counts[cell] = count
+                continue
+            self.counts.pop(cell, None)
+            block = self._block(cell)
+            cells_in_block = self.blocks.get(block)
+            if cells_in_block is not None:
+                cells_in_block.discard(cell)
+                if not cells_in_block:
+                    del self.blocks[block]
+
+    def clear(self):
+        self.counts.clear()
+        self.blocks.clear()
+
+    def nearest(self, cell: tuple[int, int]) -> 'tuple[int, int] | None':
+        """Find the closest connector to cell, by Manhattan distance."""
+        bx, by = self._block(cell)
+        best = None
+        best_dist = math.inf
+        searched = 0
+        for ring in count():
+            # Every cell in this ring of blocks is at least this far away
+            if (ring - 1) * self.BLOCK >= best_dist \
+                    or searched == len(self.blocks):
+                return best
+            for block in self._ring(bx, by, ring):
+                cells = self.blocks.get(block)
+                if not cells:
+                    continue
+                searched += 1
+                for c in cells:
+                    d = manhattan_distance(cell, c)
+                    if d < best_dist:
+                        best = c
+                        best_dist = d
+
+    @staticmethod
+    def _ring(x: int, y: int, r: int):
+        """Iterate over the blocks r blocks away from (x, y)."""
+        if r == 0:
+            yield x, y
+            return
+        for i in range(-r, r + 1):
+            yield x + i, y - r
+            yield x + i, y + r
+        for j in range(-r + 1, r):
+            yield x - r, y + j
+            yield x + r, y + j
+
+
+class BaseRegistry:
+    """The buildings of the base, and the cells they cover.
+
+    Buildings are stored densely, and are removed by moving the last
+    building into the vacated slot. Each building also has a handle, which
+    is what the occupancy grid stores: the grid is made of fixed-size chunks
+    of handles, created as needed.
+    """
+
+    CHUNK = 32  # cells along each side of a chunk
+
+    def __init__(self):
+        self.buildings = []
+        self.slots = {}  # building -> index in self.buildings
+        self.cells = {}  # building -> the cells it covers
+        self.handles = {}  # building -> handle
+        self.by_handle = {}  # handle -> building
+        self.chunks: dict[tuple[int, int], np.ndarray] = {}
+        self.next_handle = count(1)
+
+    def __len__(self):
+        return len(self.buildings)
+
+    def __iter__(self):
+        return iter(self.buildings)
+
+    def __contains__(self, building):
+        return building in self.slots
+
+    def clear(self):
+        self.buildings.clear()
+        self.slots.clear()
+        self.cells.clear()
+        self.handles.clear()
+        self.by_handle.clear()
+        self.chunks.clear()
+
+    def _locate(self, cell: tuple[int, int]):
+        x, y = cell
+        (cx, x), (cy, y) = divmod(x, self.CHUNK), divmod(y, self.CHUNK)
+        return (cx, cy), (y, x)
+
+    def _fill(self, cells, handle: int):
+        for cell in cells:
+            chunk, idx = self._locate(cell)
+            grid = self.chunks.get(chunk)
+            if grid is None:
+                grid = self.chunks[chunk] = np.zeros(
+                    (self.CHUNK, self.CHUNK), dtype=np.int32
+                )
+            grid[idx] = handle
+
+    def add(self, building: 'Building', cells: Iterable[tuple[int, int]]):
+        """Add a building covering the given cells."""
+        self.slots[building] = len(self.buildings)
+        self.buildings.append(building)
+
+        handle = next(self.next_handle)
+        self.handles[building] = handle
+        self.by_handle[handle] = building
+        self.cells[building] = cells = list(cells)
+        self._fill(cells, handle)
+
+    def remove(self, building: 'Building'):
+        """Remove a building, freeing the cells it covers."""
+        slot = self.slots.pop(building)
+        last = self.buildings.pop()
+        if last is not building:
+            self.buildings[slot] = last
+            self.slots[last] = slot
+
+        del self.by_handle[self.handles.pop(building)]
+        self._fill(self.cells.pop(building), 0)
+
+    def at(self, cell: tuple[int, int]) -> 'Building | None':
+        """Get the building covering the given cell, if any."""
+        chunk, idx = self._locate(cell)
+        grid = self.chunks.get(chunk)
+        if grid is None:
+            return None
+        return self.by_handle.get(int(grid[idx]))
+
+    def occupied(self, cell: tuple[int, int]) -> bool:
+        """Return True if a building covers the given cell."""
+        chunk, idx = self._locate(cell)
+        grid = self.chunks.get(chunk)
+        return grid is not None and grid[idx] != 0
+
+
+class PowerNetwork:
+    """The base's buildings and the wiring between them.
+
+    Buildings that are wired together share power. Connectivity is tracked
+    with a union-find structure that is updated incrementally as buildings
+    are wired up; when a building is removed, only the network it was part
+    of is recomputed.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.members: dict[object, list] = {}  # root -> buildings
+        self.power: dict[object, int] = {}  # root -> total power
+        self.links = defaultdict(set)
+        self.sockets = defaultdict(set)  # connector cell -> buildings
+
+    def clear(self):
+        self.parent.clear()
+        self.members.clear()
+        self.power.clear()
+        self.links.clear()
+        self.sockets.clear()
+
+    def add(self, building, sockets: Iterable[tuple[int, int]]):
+        """Add an unconnected building with the given connector cells."""
+        self.parent[building] = building
+        self.members[building] = [building]
+        self.power[building] = building.POWER
+        for cell in sockets:
+            self.sockets[cell].add(building)
+
+    def find(self, building):
+        """Find the root building of the network building is part of."""
+        parent = self.parent
+        while parent[building] is not building:
+            parent[building] = building = parent[parent[building]]
+        return building
+
+    def _union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a is b:
+            return
+        if len(self.members[a]) < len(self.members[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.members[a] += self.members.pop(b)
+        self.power[a] += self.power.pop(b)
+
+    def connect(self, a, b):
+        """Wire two buildings together."""
+        if a is b:
+            return
+        self.links[a].add(b)
+        self.links[b].add(a)
+        self._union(a, b)
+
+    def remove(self, building, sockets: Iterable[tuple[int, int]]):
+        """Remove a building, splitting its network if necessary."""
+        root = self.find(building)
+        members = self.members.pop(root)
+        del self.power[root]
+        for cell in sockets:
+            owners = self.sockets.get(cell)
+            if owners is not None:
+                owners.discard(building)
+                if not owners:
+                    del self.sockets[cell]
+        for other in self.links.pop(building, ()):
+            self.links[other].discard(building)
+        del self.parent[building]
+
+        members.remove(building)
+        for b in members:
+            self.parent[b] = b
+            self.members[b] = [b]
+            self.power[b] = b.POWER
+        for b in members:
+            for other in self.links.get(b, ()):
+                self._union(b, other)
+
+    def network(self, building) -> tuple[int, int]:
+        """Get the (power, number of buildings) of building's network."""
+        root = self.find(building)
+        return self.power[root], len(self.members[root])
+
+
+class RepairQueue:
+    """Damaged buildings, shared by all repair bays, most damaged first.
+
+    Buildings are pushed onto a heap keyed by health fraction whenever their
+    health changes; superseded entries are discarded lazily as they are
+    popped, or in bulk once they outnumber the live ones. A bay claims a
+    building to repair it and releases it when done.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.pending = {}  # building -> its current key in the heap
+        self.claimed = set()
+        self.seq = count()
+        self.changed = w2d.Event()
+
+    def clear(self):
+        self.heap.clear()
+        self.pending.clear()
+        self.claimed.clear()
+
+    def update(self, building):
+        """Requeue a building after its health changed."""
+        if building in self.claimed:
+            return
+        if building not in building.base.objects:
+            # Destroyed; don't send a bay to repair the ruins
+            self.pending.pop(building, None)
+            return
+        frac = building.health / type(building).health
+        if frac >= 1:
+            self.pending.pop(building, None)
+            return
+        self.pending[building] = frac
+        heapq.heappush(self.heap, (frac, next(self.seq), building))
+        if len(self.heap) > 2 * len(self.pending):
+            self._compact()
+
+        # Waiters wait on the current event, so swap before waking them
+        changed, self.changed = self.changed, w2d.Event()
+        changed.set()
+
+    def _compact(self):
+        """Drop superseded entries, such as for destroyed buildings."""
+        seq = self.seq
+        self.heap = [
+            (frac, next(seq), building)
+            for building, frac in self.pending.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def remove(self, building):
+        """Forget about a building that has been destroyed."""
+        self.pending.pop(building, None)
+        self.claimed.discard(building)
+
+    async def claim(self) -> 'Building':
+        """Wait for the most damaged unclaimed building, and claim it."""
+        while True:
+            while self.heap:
+                frac, _, building = heapq.heappop(self.heap)
+                if self.pending.get(building) == frac:
+                    del self.pending[building]
+                    self.claimed.add(building)
+                    return building
+            await self.changed
+
+    def release(self, building):
+        """Release a claimed building, requeuing it if still damaged."""
+        if building in self.claimed:
+            self.claimed.discard(building)
+            self.update(building)
+
+
 T = TypeVar('T')
 
 
@@ -105,7 +491,8 @@ class Connection(NamedTuple):
 @colgroup.handler('threx_bullet', 'building')
 def handle_collect(bullet, building):
     bullet.delete()
-    effects.pixels.emit(
+    effects.emit(
+        effects.pixels,
         random.randint(3, 6),
         pos=bullet.pos,
         vel=bullet.vel * 0.1,
@@ -119,22 +506,94 @@ def handle_collect(bullet, building):
     building.hit(bullet.damage)
 
 
+class TileBatch:
+    """A set of changes to the base's tile map, committed together.
+
+    Cells marked with update() have their connector shape recomputed from the
+    wiring once, when the batch is committed; sparks for all of them are
+    emitted in a single burst.
+    """
+    SPARKS = 10
+
+    def __init__(self, base: 'Base', sparks: bool = True):
+        self.base = base
+        self.sparks = sparks
+        self.dirty = set()
+        self.writes = {}
+
+    def update(self, x, y):
+        """Recompute the connector shape at the given position."""
+        self.dirty.add((x, y))
+
+    def set(self, cell: tuple[int, int], tile: 'str | None'):
+        """Set the tile at cell, or clear it if tile is None."""
+        self.writes[cell] = tile
+        self.dirty.discard(cell)
+
+    def commit(self):
+        base = self.base
+        shaped = [
+            cell for cell in self.dirty
+            if not base.objects.occupied(cell)
+        ]
+        for cell in shaped:
+            self.writes[cell] = base.tile_shape(cell)
+
+        tiles = base.tiles
+        for cell, tile in self.writes.items():
+            tiles[cell] = tile
+
+        if shaped and self.sparks:
+            pos = np.repeat(
+                [base.cell_to_world(c) for c in shaped],
+                self.SPARKS,
+                axis=0
+            )
+            base.sparks.emit(
+                len(pos),
+                size=20,
+                pos=pos,
+                pos_spread=0,
+                vel_spread=100,
+                age_spread=0.5,
+                angle_spread=3,
+            )
+        self.dirty.clear()
+        self.writes.clear()
+
+
+class Layout(NamedTuple):
+    """The buildings and wiring of a base, as saved in a snapshot."""
+
+    # (building type, cell, health)
+    buildings: list[tuple[type, tuple[int, int], float]]
+    # Pairs of indexes into buildings that are wired together
+    links: list[tuple[int, int]]
+    wiring: list[Connection]
+    # Connector cells, and the number of buildings using each one
+    connectors: list[tuple[tuple[int, int], int]]
+
+
 class Base:
     def __init__(self):
         self._tiles = self._sparks = None
-        self.grid = set()
-        self.objects = []
-        self.connectors: Counter[tuple[int, int]] = Counter()
+        self.objects = BaseRegistry()
+        self.connectors = ConnectorIndex()
         self.wiring: tuple[int, int, Edge] = set()
-        self.power = 0
+        self.network = PowerNetwork()
+        self.repairs = RepairQueue()
+
+        # Incremented whenever buildings are added or removed
+        self.generation = 0
 
     def clear(self):
-        for o in self.objects[:]:
+        for o in list(self.objects):
             o.delete()
-        self.grid.clear()
         self.objects.clear()
         self.connectors.clear()
         self.wiring.clear()
+        self.network.clear()
+        self.repairs.clear()
         if self._tiles:
             self._tiles.clear()
 
@@ -169,7 +628,7 @@ class Base:
         cx, cy = self.world_to_cell(pos)
         coord = vec2(cx * 48 + 24, cy * 48 + 24)
         for cell in self.cells_for((cx, cy)):
-            if cell in self.grid:
+            if self.objects.occupied(cell):
                 return coord, False
         return coord, True
 
@@ -195,11 +654,29 @@ class Base:
             (cx, cy + 2),
         }
 
+    def nearest_connector(
+            self,
+            start_points: set[tuple[int, int]],
+        ) -> tuple[tuple[int, int], tuple[int, int]]:
+        """Find the closest pair of a start point and an existing connector.
+
+        The connectors must not be empty.
+        """
+        return min(
+            ((p, self.connectors.nearest(p)) for p in start_points),
+            key=lambda pair: manhattan_distance(*pair)
+        )
+
     async def lay_connector(
             self,
             start_points: set[tuple[int, int]],
+            building: 'Building',
         ):
-        if any(p in self.grid for p in start_points):
+        for neighbour in self.wired_to(start_points):
+            self.network.connect(building, neighbour)
+
+        if any(self.objects.occupied(p) for p in start_points):
+            # We're touching another building; it's wired straight in
             return
 
         if not self.connectors:
@@ -207,10 +684,8 @@ class Base:
             return
 
         # Find closest connector by manhattan distance
-        (startx, starty), (connectx, connecty) = min(
-            product(start_points, self.connectors),
-            key=lambda pair: manhattan_distance(*pair)
-        )
+        (startx, starty), (connectx, connecty) = \
+            self.nearest_connector(start_points)
 
         self.connectors.update(start_points)
 
@@ -218,7 +693,8 @@ class Base:
         interval = 0.03
 
         # Build the path we'd like the connector to follow
-        self.update_tile(startx, starty)
+        with self.tile_batch() as batch:
+            batch.update(startx, starty)
         await sleep(interval)
 
         def mkrange(a, b):
@@ -232,47 +708,53 @@ class Base:
         for y in mkrange(starty, connecty):
             c = Connection(startx, y, Edge.BOTTOM)
             self.wiring.add(c)
-            self.update_tile(*c.cell)
-            self.update_tile(startx, y + 1)
+            with self.tile_batch() as batch:
+                batch.update(*c.cell)
+                batch.update(startx, y + 1)
             next(sounds)
             await sleep(interval)
         for x in mkrange(startx, connectx):
             c = Connection(x, connecty, Edge.RIGHT)
             self.wiring.add(c)
-            self.update_tile(*c.cell)
-            self.update_tile(x + 1, connecty)
+            with self.tile_batch() as batch:
+                batch.update(*c.cell)
+                batch.update(x + 1, connecty)
             next(sounds)
             await sleep(interval)
 
-        self.update_tile(connectx, connecty)
+        with self.tile_batch() as batch:
+            batch.update(connectx, connecty)
 
-    def update_tile(self, x, y):
-        """Update the tile at the given position."""
-        if (x, y) in self.grid:
-            return
+    @contextmanager
+    def tile_batch(self, sparks: bool = True):
+        """Collect tile changes and commit them to the tile map together."""
+        batch = TileBatch(self, sparks)
+        try:
+            yield batch
+        finally:
+            batch.commit()
+
+    def tile_shape(self, cell: tuple[int, int]) -> 'str | None':
+        """Get the connector tile for a cell, given the wiring around it."""
+        x, y = cell
         adj = (
             Connection(x - 1, y, Edge.RIGHT) in self.wiring,
             Connection(x, y, Edge.RIGHT) in self.wiring,
             Connection(x, y - 1, Edge.BOTTOM) in self.wiring,
             Connection(x, y, Edge.BOTTOM) in self.wiring,
         )
-        self.tiles[x, y] = self.ADJ_MAP.get(adj, 'connector_lr')
-        self.sparks.emit(
-            10,
-            size=20,
-            pos=self.cell_to_world((x, y)),
-            pos_spread=0,
-            vel_spread=100,
-            age_spread=0.5,
-            angle_spread=3,
-        )
+        return self.ADJ_MAP.get(adj, 'connector_lr')
 
     def burn(self, center):
-        for cell in self.cells_for(center):
-            self.tiles[cell] = 'burned'
-            self.grid.discard(cell)
-        self.connectors -= Counter(self.connectors_for(center))
-        self.wiring.difference_update(self.wiring_for(center))
+        with self.tile_batch() as batch:
+            for cell in self.cells_for(center):
+                batch.set(cell, 'burned')
+            connectors = self.connectors_for(center)
+            self.connectors.remove(connectors)
+            self.wiring.difference_update(self.wiring_for(center))
+            # Reshape the wiring that led into the building
+            for cell in connectors:
+                batch.update(*cell)
 
     ADJ_MAP = {
         # l, r, u, d
@@ -300,22 +782,104 @@ class Base:
             raise ValueError("Cannot place here")
         cell = self.world_to_cell(pos)
 
-        for pos in self.cells_for(cell):
-            del self.tiles[pos]
-        self.grid.update(self.cells_for(cell))
+        with self.tile_batch() as batch:
+            for pos in self.cells_for(cell):
+                batch.set(pos, None)
         obj = type(self, world_pos, cell)
-        self.objects.append(obj)
+        self.objects.add(obj, self.cells_for(cell))
+        self.generation += 1
 
         self.wiring.update(self.wiring_for(cell))
         connectors = self.connectors_for(cell)
+        self.network.add(obj, connectors)
         async with w2d.Nursery() as ns:
-            ns.do(self.lay_connector(connectors))
+            ns.do(self.lay_connector(connectors, obj))
             ns.do(obj.build(self))
         return obj
 
-    def sufficient_power(self, cls) -> bool:
-        """Return True if there is sufficient power to place this object."""
-        return (self.power + cls.POWER) >= len(self.objects)
+    def layout(self) -> Layout:
+        """Get the current layout of the base."""
+        buildings = list(self.objects)
+        index = {b: i for i, b in enumerate(buildings)}
+        links = [
+            (index[a], index[b])
+            for a in buildings
+            for b in self.network.links.get(a, ())
+            if index[a] < index[b]
+        ]
+        return Layout(
+            buildings=[(type(b), b.cell, b.health) for b in buildings],
+            links=links,
+            wiring=sorted(self.wiring),
+            connectors=sorted(self.connectors.counts.items()),
+        )
+
+    async def restore(self, layout: Layout):
+        """Recreate a saved layout in an empty base.
+
+        Everything is placed immediately, without construction animations.
+        """
+        objs = []
+        with self.tile_batch(sparks=False) as batch:
+            for cls, cell, health in layout.buildings:
+                obj = cls(self, self.cell_to_world(cell), cell)
+                self.objects.add(obj, self.cells_for(cell))
+                self.network.add(obj, self.connectors_for(cell))
+                obj.health = health
+                self.repairs.update(obj)
+                objs.append(obj)
+            for i, j in layout.links:
+                self.network.connect(objs[i], objs[j])
+
+            for cell, n in layout.connectors:
+                self.connectors.update([cell] * n)
+            self.wiring.update(layout.wiring)
+            for x, y, edge in layout.wiring:
+                batch.update(x, y)
+                if edge is Edge.RIGHT:
+                    batch.update(x + 1, y)
+                else:
+                    batch.update(x, y + 1)
+        self.generation += 1
+
+        async with w2d.Nursery() as ns:
+            for obj in objs:
+                ns.do(obj.build(self, instant=True))
+
+    def wired_to(self, start_points: set[tuple[int, int]]) -> set:
+        """Get the buildings that lay_connector() would wire a building into.
+
+        That is any buildings touching the start points, or failing that,
+        the owners of the nearest connector.
+        """
+        blocked = [p for p in start_points if self.objects.occupied(p)]
+        if blocked:
+            return {self.objects.at(p) for p in blocked} - {None}
+        if not self.connectors:
+            return set()
+        _, connector = self.nearest_connector(start_points)
+        return set(self.network.sockets.get(connector, ()))
+
+    def network_at(self, pos) -> tuple[int, int]:
+        """Get the (power, number of buildings) that a building placed at pos
+        would share, over every network it would be wired into.
+        """
+        start_points = self.connectors_for(self.world_to_cell(pos))
+        roots = {self.network.find(b) for b in self.wired_to(start_points)}
+        power = buildings = 0
+        for root in roots:
+            p, n = self.network.network(root)
+            power += p
+            buildings += n
+        return power, buildings
+
+    def sufficient_power(self, cls, pos) -> bool:
+        """Return True if there is sufficient power to place this object.
+
+        Buildings share power with the network they are wired into.
+        """
+        power, buildings = self.network_at(pos)
+        return (power + cls.POWER) >= buildings
 
 
 base = Base()
@@ -335,8 +899,20 @@ class Building:
         self.sprite = self.build_sprite()
         self.sprite.pos = pos
 
+    async def appear(self):
+        """Animate the building being constructed."""
+        self.sprite.scale = 0.3
+        await animate(self.sprite,
+            scale=1,
+            duration=0.3,
+            tween='decelerate'
+        )
+
     def delete(self):
         self.base.objects.remove(self)
+        self.base.network.remove(self, self.base.connectors_for(self.cell))
+        self.base.repairs.remove(self)
+        self.base.generation += 1
         self.sprite.delete()
         self.nursery.cancel()
         colgroup.untrack(self)
@@ -348,6 +924,7 @@ class Building:
         """
         self.health -= damage
         if self.health > 0:
+            self.base.repairs.update(self)
             return False
 
         for _ in range(2):
@@ -356,6 +933,11 @@ class Building:
         self.delete()
         return True
 
+    def heal(self, amount):
+        """Restore up to amount health."""
+        self.health = min(self.health + amount, type(self).health)
+        self.base.repairs.update(self)
+
 
 class Reactor(Building):
     radius = 60
@@ -372,14 +954,9 @@ class Reactor(Building):
             ],
         )
 
-    def delete(self):
-        super().delete()
-        self.base.power -= self.POWER
-
     POWER = 4
 
-    async def build(self, base):
-        self.base.power += self.POWER
+    async def appear(self):
         base, reactor = self.sprite
         for s in self.sprite:
             s.color = (1, 1, 1, 0)
@@ -393,6 +970,10 @@ class Reactor(Building):
             tween='decelerate',
             angle=random.choice((6, -6))
         )
+
+    async def build(self, base, instant=False):
+        if not instant:
+            await self.appear()
         colgroup.track(self, 'building')
 
 
@@ -417,25 +998,11 @@ class Rockets(Building):
         )
 
     async def run_radar(self):
-        radar = self.sprite[1]
-        while True:
-            da = random.uniform(1, -1)
-            await animate(
-                radar,
-                tween='accel_decel',
-                angle=radar.angle + da
-            )
-            await coro.sleep(3)
+        await play(radar_sweep(self.sprite[1]))
 
     async def run_blinkenlights(self):
-        ON_COLOR = LIGHTBLUE
-        OFF_COLOR = (0, 0, 0, 1.0)
         while True:
-            for b in self.blinkenlights:
-                for _ in range(5):
-                    await animate(b, duration=0.5, color=ON_COLOR)
-                    await animate(b, duration=0.5, color=OFF_COLOR)
-                await animate(b, duration=0.5, color=ON_COLOR)
+            await play(charge_lights(self.blinkenlights))
 
             powerup = scene.layers[0].add_sprite('rocket_pack', pos=self.pos)
             powerup.radius = 20
@@ -446,9 +1013,9 @@ class Rockets(Building):
                     showing(powerup):
                 await powerup.event
                 for b in self.blinkenlights:
-                    b.color = OFF_COLOR
+                    b.color = BLACK
 
-    async def build(self, base):
+    async def appear(self):
         self.sprite.scale = 0.3
         rot = random.randint(-2, 2) * (math.pi / 2)
         self.sprite.angle = rot
@@ -476,6 +1043,10 @@ class Rockets(Building):
                 duration=0.2,
                 tween='decelerate'
             )
+
+    async def build(self, base, instant=False):
+        if not instant:
+            await self.appear()
         with colgroup.tracking(self, "building"):
             async with self.nursery:
                 self.nursery.do(self.run_radar())
@@ -517,14 +1088,8 @@ class PhaserBay(Building):
             await coro.sleep(3)
 
     async def run_bay(self, lights, spawn_pos):
-        ON_COLOR = LIGHTBLUE
-        OFF_COLOR = (0, 0, 0, 1.0)
         while True:
-            for b in lights:
-                for _ in range(5):
-                    await animate(b, duration=0.5, color=ON_COLOR)
-                    await animate(b, duration=0.5, color=OFF_COLOR)
-                await animate(b, duration=0.5, color=ON_COLOR)
+            await play(charge_lights(lights))
 
             powerup = scene.layers[0].add_sprite(
                 'phaser_pack',
@@ -538,15 +1103,11 @@ class PhaserBay(Building):
                     showing(powerup):
                 await powerup.event
                 for b in lights:
-                    b.color = OFF_COLOR
+                    b.color = BLACK
 
-    async def build(self, base):
-        self.sprite.scale = 0.3
-        await animate(self.sprite,
-            scale=1,
-            duration=0.3,
-            tween='decelerate'
-        )
+    async def build(self, base, instant=False):
+        if not instant:
+            await self.appear()
         with colgroup.tracking(self, "building"):
             async with self.nursery:
                 self.nursery.do(self.run_bay(self.lights_top, vec2(-26, -33)))
@@ -565,28 +1126,15 @@ class RepairBay(Building):
         self.iris.scale = 0.01
         self.iris_waiting = w2d.Event()
         self.iris_open = w2d.Event()
-        self.repairing = set()
         return group
 
     async def run_drones(self):
         while True:
-            most_damaged = None
-            most_damaged_frac = 2
-            for o in self.base.objects:
-                frac = o.health / type(o).health
-                if frac >= 1:
-                    continue
-                if o in self.repairing:
-                    continue
-                if frac < most_damaged_frac:
-                    most_damaged_frac = frac
-                    most_damaged = o
-            if most_damaged:
-                self.nursery.do(self.drone(most_damaged))
+            target = await self.base.repairs.claim()
+            self.nursery.do(self.drone(target))
             await coro.sleep(1)
 
     async def drone(self, target):
-        self.repairing.add(target)
         DRONE_SPEED = 200
         try:
             await self.open_iris()
@@ -638,19 +1186,25 @@ class RepairBay(Building):
                     )
                     light = effects.mklight(pos=drone.pos, color=(1, 1, 0.9, 1.0))
                     light.scale = 1.5
-                    target.health = min(target.health + 4, type(target).health)
+                    target.heal(4)
                     with showing(light):
                         await animate(light, duration=0.4, scale=0.1)
 
+                def destroyed():
+                    return target.health <= 0 \
+                        or target not in self.base.objects
+
                 new_pos = dest
                 while target.health < type(target).health:
                     await go_to(new_pos)
-                    if target.health < 0:
+                    if destroyed():
                         break
                     await face(target.pos)
-                    if target.health < 0:
+                    if destroyed():
                         break
                     await heal()
+                    if destroyed():
+                        break
                     new_pos = target.pos + random_ring(66)
 
                 await go_to(self.pos)
@@ -662,7 +1216,7 @@ class RepairBay(Building):
                     color=(0, 0, 0, 1.0)
                 )
         finally:
-            self.repairing.discard(target)
+            self.base.repairs.release(target)
 
     async def open_iris(self):
         if self.iris_open.is_set():
@@ -673,20 +1227,20 @@ class RepairBay(Building):
     async def iris_control(self):
         while True:
             await self.iris_waiting
-            await animate(self.iris, duration=0.1, tween='decelerate', scale=1.0)
-            self.iris_open.set()
-            await coro.sleep(1.0)
-            self.iris_open = w2d.Event()
-            self.iris_waiting = w2d.Event()
-            await animate(self.iris, duration=0.1, tween='decelerate', scale=0.01)
-
-    async def build(self, base):
-        self.sprite.scale = 0.3
-        await animate(self.sprite,
-            scale=1,
-            duration=0.3,
-            tween='decelerate'
-        )
+            cycle = Timeline([(self.iris, 'scale', IRIS_CYCLE)])
+            opened = cycle.at(IRIS_OPENED)
+            closing = cycle.at(IRIS_CLOSING)
+            async with w2d.Nursery() as ns:
+                ns.do(play(cycle))
+                await opened
+                self.iris_open.set()
+                await closing
+                self.iris_open = w2d.Event()
+                self.iris_waiting = w2d.Event()
+
+    async def build(self, base, instant=False):
+        if not instant:
+            await self.appear()
         with colgroup.tracking(self, "building"):
             async with self.nursery:
                 self.nursery.do(self.run_drones())
@@ -722,7 +1276,7 @@ async def building_mode(ship, player, construction_ns):
         ('blueprint_reactor', Reactor, 2000),
     ])
     blueprint, cls, cost = items[0]
-    if not base.sufficient_power(cls):
+    if not base.sufficient_power(cls, insertion_point()):
         items.appendleft(items.pop())  # Cycle to the reactor
         blueprint, cls, cost = items[0]
 
@@ -733,7 +1287,7 @@ async def building_mode(ship, player, construction_ns):
         pos, can_place = base.can_place(insertion_point())
         if cost > player.balance.value:
             can_place = False
-        elif not base.sufficient_power(cls):
+        elif not base.sufficient_power(cls, insertion_point()):
             can_place = False
         obj.pos = pos
         obj.color = 'white' if can_place else 'red'
@@ -753,12 +1307,12 @@ async def building_mode(ship, player, construction_ns):
                 pos, can_place = base.can_place(point)
                 if cost > player.balance.value:
                     # Speak
-                    w2d.sounds.insufficient_funds.play()
+                    sfx.say('insufficient_funds')
                     ns.cancel()
                     continue
-                if not base.sufficient_power(cls):
+                if not base.sufficient_power(cls, point):
                     # Speak
-                    w2d.sounds.insufficient_power.play()
+                    sfx.say('insufficient_power')
                     ns.cancel()
                     continue
                 if can_place:
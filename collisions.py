@@ -1,10 +1,20 @@
 from functools import partial
-from itertools import combinations
+from itertools import combinations, product
 from typing import Iterable, Tuple
 from contextlib import contextmanager
+from collections import defaultdict
+from operator import itemgetter
+from math import floor, sqrt
 import random
 
 
+# Cell size for the spatial index used by segment queries, px
+INDEX_CELL = 128
+
+# Objects move after the index is built; search this much further, px
+INDEX_SLACK = 16
+
+
 class CollisionGroup:
     """Find object collisions using a sort-and-sweep broad phase."""
 
@@ -15,6 +25,9 @@ class CollisionGroup:
         self.handlers = {}
         self.by_type: dict[str, set] = {}
 
+        # Spatial index for each type, built on demand once per frame
+        self.index: dict[str, dict[tuple[int, int], list]] = {}
+
     def add_handler(self, type_a: str, type_b: str, func):
         """Register an object"""
         self.handlers[type_a, type_b] = func
@@ -26,6 +39,7 @@ class CollisionGroup:
         """Decorator to register a handler for some types"""
         def dec(func):
             self.add_handler(type_a, type_b, func)
+            return func
         return dec
 
     def track(self, obj: object, type: str):
@@ -36,7 +50,13 @@ class CollisionGroup:
         assert type in self.by_type, \
             f"No collision handlers for {type}"
         self.by_type[type].add(obj)
-        self.objects.append(obj)
+        self.index.pop(type, None)
+        if obj in self.dead:
+            # Untracked and tracked again before the dead were swept; it is
+            # still in self.objects
+            self.dead.discard(obj)
+        else:
+            self.objects.append(obj)
         self.types[obj] = type
 
     def untrack(self, obj: object):
@@ -68,9 +88,91 @@ class CollisionGroup:
                 found.append(o)
         return found
 
+    def _cells(self, x1, y1, x2, y2):
+        """Iterate over the index cells covering a bounding box."""
+        return product(
+            range(floor(x1 / INDEX_CELL), floor(x2 / INDEX_CELL) + 1),
+            range(floor(y1 / INDEX_CELL), floor(y2 / INDEX_CELL) + 1),
+        )
+
+    def _get_index(self, type) -> dict[tuple[int, int], list]:
+        """Get the spatial index of objects of the given type."""
+        try:
+            return self.index[type]
+        except KeyError:
+            pass
+        index = self.index[type] = defaultdict(list)
+        for o in self.by_type[type]:
+            x, y = o.pos
+            r = o.radius
+            for cell in self._cells(x - r, y - r, x + r, y + r):
+                index[cell].append(o)
+        return index
+
+    def segment_cast(
+            self,
+            start,
+            end,
+            type: str,
+            radius: float = 0) -> list[tuple[float, object]]:
+        """Find objects touched by a circle of radius swept from start to end.
+
+        Return a list of (t, object) in the order they are hit, where t is
+        the fraction of the way along the segment at which they are hit.
+        """
+        index = self._get_index(type)
+        live = self.by_type[type]
+        ax, ay = start
+        dx, dy = end - start
+        length2 = dx * dx + dy * dy
+        margin = radius + INDEX_SLACK
+
+        seen = set()
+        hits = []
+        for cell in self._cells(
+                min(ax, ax + dx) - margin,
+                min(ay, ay + dy) - margin,
+                max(ax, ax + dx) + margin,
+                max(ay, ay + dy) + margin):
+            for o in index.get(cell, ()):
+                if o in seen or o not in live:
+                    continue
+                seen.add(o)
+                ox, oy = o.pos
+                px = ox - ax
+                py = oy - ay
+                if length2:
+                    t = min(max((px * dx + py * dy) / length2, 0), 1)
+                else:
+                    t = 0
+                cx = px - dx * t
+                cy = py - dy * t
+                reach2 = (o.radius + radius) ** 2
+                miss2 = cx * cx + cy * cy
+                if miss2 >= reach2:
+                    continue
+                if length2:
+                    # Back up to where the circles first touched
+                    t = max(t - sqrt((reach2 - miss2) / length2), 0)
+                hits.append((t, o))
+        hits.sort(key=itemgetter(0))
+        return hits
+
+    def line_of_sight(self, start, end, type='building', ignore=()) -> bool:
+        """Return True if no object of type blocks the line start to end.
+
+        Objects in ignore - such as the things at either end of the line -
+        don't block.
+        """
+        return all(
+            o in ignore
+            for _, o in self.segment_cast(start, end, type)
+        )
+
     def find_collisions(self) -> Iterable[Tuple[object, object]]:
         self.objects = [o for o in self.objects if o not in self.dead]
         self.dead.clear()
+        self.index.clear()
 
         if not self.objects:
             return
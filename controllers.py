@@ -1,10 +1,15 @@
 import sys
+import re
+import json
+import hashlib
 import pygame
 import wasabi2d as w2d
 from pygame import joystick
 from wasabigeom import vec2
 from pathlib import Path
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from helpers import CACHE_DIR
 
 controller_db = Path(__file__).parent / 'data/gamecontrollerdb.txt'
 
@@ -25,36 +30,131 @@ else:
     PLATFORM = 'unknown'
 
 
-@lru_cache()
-def load_db() -> dict:
-    data = {}
-    with controller_db.open() as f:
-        for lineno, line in enumerate(f, start=1):
-            line = line.strip()
-            if line.startswith('#') or not line:
-                continue
+# Bump this when the format of the index file changes
+INDEX_VERSION = 1
 
-            try:
-                guid, name, *kvs = line.rstrip(',').split(',')
-            except ValueError:
-                raise ValueError(
-                    f"Error parsing {controller_db} at line {lineno}: {line!r}"
-                )
-            mapping = {}
-            for kv in kvs:
-                key, colon, value = kv.partition(':')
-                if not colon:
-                    raise ValueError(
-                        f"Error parsing {controller_db} "
-                        f"at line {lineno}: {line!r}"
-                    )
-                mapping[key] = value
-            platform = mapping.pop('platform').strip()
-            if platform != PLATFORM:
-                # Drop data that doesn't correspond to the current platform
-                continue
-            data[guid] = name, mapping
-    return data
+
+def parse_mapping(line: str, offset: int) -> tuple[str, dict]:
+    """Parse a line of the controller DB into a name and mapping."""
+    try:
+        guid, name, *kvs = line.strip().rstrip(',').split(',')
+    except ValueError:
+        raise ValueError(
+            f"Error parsing {controller_db} at byte {offset}: {line!r}"
+        )
+    mapping = {}
+    for kv in kvs:
+        key, colon, value = kv.partition(':')
+        if not colon:
+            raise ValueError(
+                f"Error parsing {controller_db} "
+                f"at byte {offset}: {line!r}"
+            )
+        mapping[key] = value
+    mapping.pop('platform', None)
+    return name, mapping
+
+
+def build_index(data: bytes, platform: str) -> dict[str, int]:
+    """Find the byte offset of the line for each controller on platform."""
+    matches_platform = re.compile(
+        rb'(?:^|,)platform:\s*' + re.escape(platform.encode()) + rb'\s*(?:,|$)'
+    ).search
+    index = {}
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        if not line.startswith(b'#') and matches_platform(line.rstrip()):
+            guid = line.split(b',', 1)[0].strip().decode('ascii')
+            index[guid] = offset
+        offset += len(line)
+    return index
+
+
+class ControllerDB:
+    """Look up controller mappings in the Game Controller DB.
+
+    An index of where each of this platform's controllers is in the file is
+    built in the background, and cached on disk until the file changes. Only
+    the lines for controllers that are actually attached get parsed.
+    """
+
+    def __init__(self, path: Path, index_path: Path):
+        self.path = path
+        self.index_path = index_path
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='controllerdb',
+        )
+        self.loading: 'Future | None' = None
+        self.mappings = {}
+
+    def load(self) -> Future:
+        """Start loading the index, if it isn't already."""
+        if self.loading is None:
+            self.loading = self.executor.submit(self._load_index)
+        return self.loading
+
+    async def ready(self):
+        """Wait for the index to load."""
+        import clocks
+
+        loading = self.load()
+        while not loading.done():
+            await clocks.ui.coro.next_frame()
+
+    def _load_index(self) -> dict[str, int]:
+        stat = self.path.stat()
+        try:
+            cached = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            cached = None
+        if not cached \
+                or cached.get('version') != INDEX_VERSION \
+                or cached.get('platform') != PLATFORM:
+            cached = None
+        elif (cached['size'], cached['mtime_ns']) \
+                == (stat.st_size, stat.st_mtime_ns):
+            return cached['index']
+
+        data = self.path.read_bytes()
+        digest = hashlib.sha1(data).hexdigest()
+        if cached and cached['sha1'] == digest:
+            index = cached['index']
+        else:
+            index = build_index(data, PLATFORM)
+
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            self.index_path.write_text(json.dumps({
+                'version': INDEX_VERSION,
+                'platform': PLATFORM,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha1': digest,
+                'index': index,
+            }))
+        except OSError:
+            pass  # Caching is best effort
+        return index
+
+    def get(self, guid: str, default=None):
+        """Get the (name, mapping) for a controller GUID."""
+        if guid in self.mappings:
+            return self.mappings[guid]
+        offset = self.load().result().get(guid)
+        if offset is None:
+            return default
+        with self.path.open('rb') as f:
+            f.seek(offset)
+            line = f.readline().decode('utf8')
+        found = self.mappings[guid] = parse_mapping(line, offset)
+        return found
+
+
+db = ControllerDB(
+    controller_db,
+    CACHE_DIR / f"controllerdb-{PLATFORM.replace(' ', '_')}.json",
+)
 
 
 DEFAULT_MAPPING = {
@@ -94,7 +194,7 @@ class Controller:
         self.id = self.stick.get_instance_id()
 
         guid = self.stick.get_guid()
-        self.name, mapping = load_db().get(guid, DEFAULT_MAPPING)
+        self.name, mapping = db.get(guid, ('Unknown', DEFAULT_MAPPING))
         self.leftx = getter(mapping['leftx'], self.stick)
         self.lefty = getter(mapping['lefty'], self.stick)
 
@@ -154,8 +254,8 @@ player_count = 0
 
 async def hotplug():
     global player_count
-    import clocks
 
+    await db.ready()
     while True:
         # FIXME: we should not lose track of which stick is bound to which slot
         num_sticks = joystick.get_count()
@@ -1,4 +1,5 @@
 import random
+from math import hypot, inf
 
 import numpy as np
 import wasabi2d as w2d
@@ -11,16 +12,61 @@ from clocks import animate, coro
 import sfx
 
 scene: w2d.Scene
+hud_viewport = None
 game: w2d.Nursery
 pixels: ParticleGroup = None
 smoke: ParticleGroup = None
 flame: ParticleGroup = None
+budgets: dict[str, 'ParticleBudget'] = {}
 
 
-def init(s: w2d.Scene):
-    global pixels, smoke, flame, scene
+# Cosmetic effects further than this outside every viewport are not emitted
+CULL_MARGIN = 200
+
+# Maximum number of live particles in each group
+CAPACITY = {
+    'pixels': 5000,
+    'smoke': 2000,
+    'flame': 4000,
+}
+
+
+class ParticleBudget:
+    """Cap the number of live particles in a particle group.
+
+    The group stores its particles oldest first, so when it is full we evict
+    the oldest particles by expiring a prefix of the buffer; the group then
+    drops them as part of the emit. This also applies to the group's emitters.
+    """
+
+    def __init__(self, group: ParticleGroup, capacity: int):
+        self.group = group
+        self.capacity = capacity
+        self.emitted = 0
+        self.evicted = 0
+        self._emit = group.emit
+        group.emit = self.emit
+
+    def emit(self, num, **kwargs):
+        num = min(round(num), self.capacity)
+        if num <= 0:
+            return
+        max_age = self.group.max_age
+        ages = self.group.lst.vertbuf['in_age']
+        alive = np.flatnonzero(ages < max_age)
+        excess = len(alive) + num - self.capacity
+        if excess > 0:
+            ages[alive[:excess]] = max_age
+            self.evicted += excess
+        self.emitted += num
+        self._emit(num, **kwargs)
+
+
+def init(s: w2d.Scene, hud=None):
+    global pixels, smoke, flame, scene, hud_viewport
 
     scene = s
+    hud_viewport = hud
     pixels = scene.layers[1].add_particle_group(
         max_age=1.5,
         clock=clocks.game,
@@ -54,12 +100,49 @@ def init(s: w2d.Scene):
     flame.add_color_stop(0.5, (0, 0, 0.0, 1))
     flame.add_color_stop(1, (0, 0, 0, 0))
 
+    for name, group in [('pixels', pixels), ('smoke', smoke), ('flame', flame)]:
+        budgets[name] = ParticleBudget(group, CAPACITY[name])
+
+
+def viewports() -> list:
+    """Get the viewports that are currently showing the game world."""
+    return [vp for vp in scene.viewports if vp is not hud_viewport]
+
+
+def view_distance(pos) -> float:
+    """Get the distance from pos to the nearest player viewport.
+
+    This is 0 if pos is on screen.
+    """
+    x, y = pos
+    nearest = inf
+    for vp in viewports():
+        cx, cy = vp.camera.pos
+        dx = max(abs(x - cx) - vp.width / 2, 0)
+        dy = max(abs(y - cy) - vp.height / 2, 0)
+        nearest = min(nearest, hypot(dx, dy))
+    return nearest
+
+
+def visible(pos, margin=CULL_MARGIN) -> bool:
+    """Return True if pos is within margin of any player viewport."""
+    return view_distance(pos) < margin
+
+
+def emit(group: ParticleGroup, num, *, pos, **kwargs):
+    """Emit particles into group, unless nobody would see them."""
+    if visible(pos):
+        group.emit(num, pos=pos, **kwargs)
+
 
 def mklight(pos=vec2(0, 0), color='white'):
     return scene.layers[99].add_sprite('point_light', pos=pos, color=color)
 
 
 def pop(pos, vel, color=(1, 1, 1, 1)):
+    if not visible(pos):
+        return
+
     async def run_pop():
         ring = scene.layers[1].add_sprite(
             'light_01',
@@ -88,6 +171,8 @@ def pop(pos, vel, color=(1, 1, 1, 1)):
 
 def explode(pos, vel):
     sfx.explosion.play()
+    if not visible(pos):
+        return
     scene.camera.screen_shake(10)
     smoke.emit(
         20,
@@ -125,9 +210,10 @@ def explode(pos, vel):
         game.do(trail())
 
 
-async def trail(obj, color='white', stroke_width=2, relpos=vec2(-10, 0)):
+def mktrail(pos, color='white', stroke_width=2):
+    """Create the line for a trail, collapsed at pos."""
     trail = scene.layers[1].add_line(
-        [obj.pos] * 50,
+        [pos] * 50,
         color=color,
         stroke_width=stroke_width,
     )
@@ -135,12 +221,44 @@ async def trail(obj, color='white', stroke_width=2, relpos=vec2(-10, 0)):
     colors = trail.colors
     colors[:, 3] = np.linspace(alpha, 0, 50) ** 2
     trail.colors = colors
+    return trail
+
+
+async def trail(
+        obj,
+        color='white',
+        stroke_width=2,
+        relpos=vec2(-10, 0),
+        line=None):
+    """Draw a trail behind obj.
+
+    line may be a line created in advance with mktrail().
+    """
+    if line is None:
+        trail = mktrail(obj.pos, color, stroke_width)
+    else:
+        trail = line
 
     with showing(trail):
         t = 0
+        hidden = False
         async for dt in coro.frames_dt():
             stern = obj.pos + relpos.rotated(obj.angle)
+            if not visible(stern):
+                if not hidden:
+                    # Don't leave the trail hanging where the ship left view
+                    verts = trail.vertices
+                    verts[:] = stern
+                    trail.vertices = verts
+                    hidden = True
+                continue
             verts = trail.vertices
+            if hidden:
+                # Start the history afresh, rather than streak from where
+                # the ship was last seen
+                verts[:] = stern
+                t = 0
+                hidden = False
             verts[0] = stern
             t += dt
             if t > 1 / 60:
@@ -0,0 +1,173 @@
+"""Flow fields that guide the Threx to their targets around the base.
+
+Rather than every ship working out its own route, the play area is divided
+into a coarse grid, and for each building under attack we solve the
+distance from every cell to that building, leading around the other
+buildings in the way. Ships then steer down the slope of the field with a
+single lookup.
+
+Fields are solved on the AI worker, for each building as it is first
+targeted, and thrown away whenever buildings are added or removed.
+"""
+import heapq
+from math import inf, sqrt
+
+import numpy as np
+from wasabigeom import vec2
+
+import building
+from aiworker import worker
+
+CELL_SIZE = 96  # px
+EXTENT = 2304  # Distance from the origin to the edge of the field, px
+CELLS = 2 * EXTENT // CELL_SIZE  # Cells along each side
+
+# Offsets to the neighbours of a cell, and the cost of moving to them
+NEIGHBOURS = [
+    (dx, dy, sqrt(dx * dx + dy * dy))
+    for dx in (-1, 0, 1)
+    for dy in (-1, 0, 1)
+    if dx or dy
+]
+
+
+def solve_distances(owners: np.ndarray, goal: int) -> np.ndarray:
+    """Get the length of the shortest path from each cell to the goal.
+
+    owners is a grid of the handles of the buildings covering each cell,
+    and goal the handle of the building to reach. Paths don't cross other
+    buildings, or cut their corners. Cells that can't reach the goal are
+    inf.
+    """
+    blocked = ((owners != 0) & (owners != goal)).tolist()
+    dist = [[inf] * CELLS for _ in range(CELLS)]
+    queue = []
+    for y, x in zip(*np.nonzero(owners == goal)):
+        y, x = int(y), int(x)
+        dist[y][x] = 0.0
+        queue.append((0.0, x, y))
+
+    while queue:
+        d, x, y = heapq.heappop(queue)
+        if d > dist[y][x]:
+            continue
+        for dx, dy, cost in NEIGHBOURS:
+            nx = x + dx
+            ny = y + dy
+            if not (0 <= nx < CELLS and 0 <= ny < CELLS) or blocked[ny][nx]:
+                continue
+            if dx and dy and (blocked[y][nx] or blocked[ny][x]):
+                continue
+            nd = d + cost
+            if nd < dist[ny][nx]:
+                dist[ny][nx] = nd
+                heapq.heappush(queue, (nd, nx, ny))
+    return np.array(dist)
+
+
+def solve_field(owners: np.ndarray, goal: int) -> list:
+    """Get the direction to head in from each cell to reach the goal.
+
+    Return a list of unit vec2, in row-major order, or None for cells that
+    are covered by a building or can't reach the goal.
+    """
+    dist = solve_distances(owners, goal)
+    reachable = np.isfinite(dist) & (dist > 0)
+
+    # Take the slope with a Sobel filter, which keeps the directions smooth
+    # across open ground. Cells that can't be entered count as uphill, so
+    # ships are steered away from the buildings in their way.
+    padded = np.pad(dist, 1, constant_values=inf)
+    uphill = np.where(np.isfinite(dist), dist, 0) + 1
+    gx = np.zeros_like(dist)
+    gy = np.zeros_like(dist)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if not (dx or dy):
+                continue
+            weight = 2 if not (dx and dy) else 1
+            n = padded[1 + dy:1 + dy + CELLS, 1 + dx:1 + dx + CELLS]
+            n = np.where(np.isfinite(n), n, uphill)
+            gx -= dx * weight * n
+            gy -= dy * weight * n
+
+    length = np.hypot(gx, gy)
+    return [
+        vec2(x / l, y / l) if ok and l > 0 else None
+        for x, y, l, ok in zip(
+            gx.ravel().tolist(),
+            gy.ravel().tolist(),
+            length.ravel().tolist(),
+            reachable.ravel().tolist(),
+        )
+    ]
+
+
+class FlowField:
+    def __init__(self, base: building.Base):
+        self.base = base
+        self.generation = None
+        self.owners = None
+        self.fields = {}  # building -> list of directions for each cell
+        self.jobs = set()  # names of jobs in flight on the worker
+
+    def refresh(self):
+        """Discard the fields, after buildings were added or removed."""
+        self.generation = self.base.generation
+        self.fields.clear()
+        self.jobs = {name for name in self.jobs if not worker.collect(name)}
+
+        objects = self.base.objects
+        self.owners = owners = np.zeros((CELLS, CELLS), dtype=np.int32)
+        for obj, cells in objects.cells.items():
+            handle = objects.handles[obj]
+            for cell in cells:
+                x, y = self.base.cell_to_world(cell)
+                i = int((x + EXTENT) // CELL_SIZE)
+                j = int((y + EXTENT) // CELL_SIZE)
+                if 0 <= i < CELLS and 0 <= j < CELLS:
+                    owners[j, i] = handle
+
+    def solve(self, target) -> 'list | None':
+        """Get the field leading to target, if it has been solved.
+
+        If not, start solving it on the AI worker.
+        """
+        handle = self.base.objects.handles.get(target)
+        if handle is None:
+            return None
+
+        name = f'flowfield{handle}'
+        result = worker.collect(name)
+        if result:
+            self.jobs.discard(name)
+            generation, directions = result
+            if generation == self.generation:
+                self.fields[target] = directions
+                return directions
+
+        if worker.submit(
+                name, self.generation, solve_field, self.owners, handle):
+            self.jobs.add(name)
+        return None
+
+    def direction(self, pos, target) -> 'vec2 | None':
+        """Get the unit direction from pos along the route to target.
+
+        Return None if pos is outside the field or over a building, if there
+        is no route, or if the field has not been solved yet.
+        """
+        if self.generation != self.base.generation:
+            self.refresh()
+        x, y = pos
+        i = int((x + EXTENT) // CELL_SIZE)
+        j = int((y + EXTENT) // CELL_SIZE)
+        if not (0 <= i < CELLS and 0 <= j < CELLS):
+            return None
+        field = self.fields.get(target) or self.solve(target)
+        if field is None:
+            return None
+        return field[j * CELLS + i]
+
+
+field = FlowField(building.base)
@@ -0,0 +1,129 @@
+"""Homing guidance for the player's rockets.
+
+Rather than each rocket searching for and chasing its own target, guidance
+is updated for all live rockets at once, each frame. Rockets are spread over
+targets so that several rockets fired together don't all chase a Threx that
+the first one would destroy.
+"""
+from contextlib import contextmanager
+from math import pi, tau
+
+import numpy as np
+from wasabigeom import vec2
+
+from collisions import colgroup
+from clocks import coro
+from helpers import positions
+
+SEEK_RANGE = 200  # How close a target must be for a rocket to lock on, px
+TURN_RATE = 10  # radians/s
+
+
+def solve_guidance(pos, vel, target_pos, target_vel, turn):
+    """Turn rockets towards the points where they would intercept targets.
+
+    turn is the maximum angle through which the rockets can turn.
+
+    Return the rockets' new velocities.
+    """
+    speed = np.hypot(vel[:, 0], vel[:, 1])
+    sep = target_pos - pos
+    time_to_target = np.hypot(sep[:, 0], sep[:, 1]) / np.maximum(speed, 1)
+    aim = sep + target_vel * time_to_target[:, np.newaxis]
+
+    heading = np.arctan2(vel[:, 1], vel[:, 0])
+    off_target = (np.arctan2(aim[:, 1], aim[:, 0]) - heading + pi) % tau - pi
+    off_target[np.abs(off_target) < 1e-2] = 0
+    heading += np.clip(off_target, -turn, turn)
+    return np.stack([np.cos(heading), np.sin(heading)], axis=1) \
+        * speed[:, np.newaxis]
+
+
+class Guidance:
+    """Steer all live rockets towards their targets."""
+
+    def __init__(self):
+        self.rockets = set()
+
+    @contextmanager
+    def guiding(self, rocket):
+        """Guide the rocket within the context.
+
+        The rocket should have .pos, .vel and .damage attributes. Guidance
+        updates .vel and .angle; the rocket is responsible for moving.
+        """
+        rocket.target = None
+        self.rockets.add(rocket)
+        try:
+            yield rocket
+        finally:
+            self.rockets.discard(rocket)
+
+    def assign_targets(self):
+        """Lock rockets without a live target onto the best target in range.
+
+        Rockets prefer the nearest target that isn't already going to be
+        destroyed by the rockets chasing it.
+        """
+        threx = colgroup.by_type['threx']
+        pending = {}
+        seeking = []
+        for rocket in self.rockets:
+            if not rocket:
+                # Deleted by a collision this frame
+                continue
+            if rocket.target in threx:
+                t = rocket.target
+                pending[t] = pending.get(t, 0) + rocket.damage
+            else:
+                rocket.target = None
+                seeking.append(rocket)
+        if not seeking or not threx:
+            return
+
+        targets = list(threx)
+        sep = positions(targets)[np.newaxis, :, :] \
+            - positions(seeking)[:, np.newaxis, :]
+        dist = np.einsum('ijk,ijk->ij', sep, sep)
+        radii = np.array([t.radius for t in targets])
+        dist[dist >= SEEK_RANGE ** 2 + radii ** 2] = np.inf
+        health = np.array([t.health for t in targets], dtype=float)
+
+        for rocket, row in zip(seeking, dist):
+            remaining = health - [pending.get(t, 0) for t in targets]
+            choices = np.where(remaining > 0, row, np.inf)
+            if np.isinf(choices).all():
+                # Everything in range is dealt with; pile on anyway
+                choices = row
+            i = np.argmin(choices)
+            if np.isinf(choices[i]):
+                continue
+            t = rocket.target = targets[i]
+            pending[t] = pending.get(t, 0) + rocket.damage
+
+    def update(self, dt):
+        """Turn all rockets with targets, in one batch."""
+        self.assign_targets()
+        rockets = [r for r in self.rockets if r and r.target is not None]
+        if not rockets:
+            return
+        targets = [r.target for r in rockets]
+        vels = solve_guidance(
+            positions(rockets),
+            np.array([tuple(r.vel) for r in rockets]),
+            positions(targets),
+            np.array([tuple(t.vel) for t in targets]),
+            TURN_RATE * dt,
+        )
+        for rocket, vel in zip(rockets, vels.tolist()):
+            rocket.vel = vel = vec2(*vel)
+            rocket.angle = vel.angle()
+
+
+guidance = Guidance()
+
+
+async def run_guidance():
+    """Guide rockets, every frame."""
+    async for dt in coro.frames_dt():
+        guidance.update(dt)
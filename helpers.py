@@ -1,11 +1,18 @@
 from contextlib import contextmanager
+import os
 import random
 from math import tau, pi
+from pathlib import Path
 
 import numpy as np
 import wasabi2d as w2d
 from wasabigeom import vec2
 
+# Where to keep files that can be regenerated, between runs
+CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+) / 'axium'
+
 
 def random_vec2(spread) -> vec2:
     return vec2(
@@ -14,6 +21,11 @@ def random_vec2(spread) -> vec2:
     )
 
 
+def positions(objs) -> np.ndarray:
+    """Get the positions of objs as an (n, 2) array."""
+    return np.array([tuple(o.pos) for o in objs], dtype=float).reshape(-1, 2)
+
+
 def random_ring(r) -> vec2:
     """Get a random point on a ring of radius r around the origin."""
     return vec2(0, r).rotated(random.uniform(0, tau))
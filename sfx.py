@@ -2,20 +2,239 @@ from pygame import mixer
 from pygame.mixer import Sound
 import pyfxr
 import random
-from functools import lru_cache
+import os
+import mmap
+import hashlib
+import wave
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
 
 import wasabi2d as w2d
 
-mixer.pre_init(44100, channels=1)
-mixer.init()
-
 from wasabi2d import music
 
-music.set_volume(0.2)
-music.play('for_robots')
+import clocks
+import helpers
+
+# Mixer settings: (frequency, format, channels)
+MIXER_SETTINGS = (44100, -16, 1)
+MUSIC_VOLUME = 0.2
+
+
+# Synthesized sounds are cached here between runs
+CACHE_DIR = helpers.CACHE_DIR / 'sfx'
+
+try:
+    PYFXR_VERSION = metadata.version('pyfxr')
+except metadata.PackageNotFoundError:
+    PYFXR_VERSION = 'unknown'
+
+synth_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='sfx')
+
+# Music is opened on its own thread, so it doesn't queue behind synthesis
+music_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='music')
+
+
+def cache_key(params: dict) -> str:
+    """Get a key that identifies the sound synthesized from params."""
+    desc = repr((PYFXR_VERSION, sorted((k, str(v)) for k, v in params.items())))
+    return hashlib.sha1(desc.encode()).hexdigest()
+
+
+def synthesize(params: dict):
+    """Get the sample buffer for a sound, from the cache if possible."""
+    path = CACHE_DIR / f'{cache_key(params)}.raw'
+    try:
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError means an empty file, which we overwrite
+        pass
+
+    buf = pyfxr.SFX(**params)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_bytes(memoryview(buf))
+        os.replace(tmp, path)
+    except OSError:
+        pass  # Caching is best effort
+    return buf
+
+
+# Mixer channels; the first EFFECT_CHANNELS are allocated by the voice
+# manager, the rest are left for other sounds.
+CHANNELS = 16
+EFFECT_CHANNELS = 12
+
+# Channel volume for a single play. Sounds are made louder to compensate,
+# leaving headroom to boost plays that other plays were coalesced into.
+VOICE_VOLUME = 0.6
+COALESCE_BOOST = 0.15
+
+
+class Voices:
+    """Allocate mixer channels to sound effects.
+
+    Each sound can play on at most max_voices channels at once. Repeated
+    plays of a sound in the same frame are coalesced into one louder play.
+    If no channel is free, the new sound steals the channel of the oldest
+    sound with the lowest priority, as long as that isn't higher than its
+    own.
+    """
+
+    def __init__(self):
+        mixer.set_num_channels(CHANNELS)
+        mixer.set_reserved(EFFECT_CHANNELS)
+        self.channels = [mixer.Channel(i) for i in range(EFFECT_CHANNELS)]
+        # For each channel, (priority, start time, sound) of its last play
+        self.owners = [None] * EFFECT_CHANNELS
+        self.frame = None
+        self.coalesced = {}  # sound -> (channel, plays) in this frame
+
+    def _playing(self, i) -> bool:
+        owner = self.owners[i]
+        if owner is None:
+            return False
+        ch = self.channels[i]
+        if ch.get_busy() and ch.get_sound() is owner[2].sound:
+            return True
+        self.owners[i] = None
+        return False
+
+    def _choose_channel(self, sound: 'LazySound') -> 'int | None':
+        playing = [i for i in range(EFFECT_CHANNELS) if self._playing(i)]
+        same = [i for i in playing if self.owners[i][2] is sound]
+        if len(same) >= sound.max_voices:
+            return min(same, key=lambda i: self.owners[i][1])
+        if len(playing) < EFFECT_CHANNELS:
+            return next(
+                i for i in range(EFFECT_CHANNELS) if self.owners[i] is None
+            )
+        victim = min(playing, key=lambda i: self.owners[i][:2])
+        if self.owners[victim][0] > sound.priority:
+            return None
+        return victim
+
+    def play(self, sound: 'LazySound'):
+        snd = sound.sound
+        if not snd:
+            return
+
+        now = clocks.ui.t
+        if now != self.frame:
+            self.frame = now
+            self.coalesced.clear()
+        if sound in self.coalesced:
+            channel, plays = self.coalesced[sound]
+            if channel.get_sound() is snd:
+                plays += 1
+                self.coalesced[sound] = channel, plays
+                channel.set_volume(
+                    min(VOICE_VOLUME + COALESCE_BOOST * (plays - 1), 1.0)
+                )
+                return
+
+        i = self._choose_channel(sound)
+        if i is None:
+            return
+        channel = self.channels[i]
+        channel.set_volume(VOICE_VOLUME)
+        channel.play(snd)
+        self.owners[i] = (sound.priority, now, sound)
+        self.coalesced[sound] = channel, 1
+
+
+# Set up by init(); while this is None, sound effects are silent
+voices: 'Voices | None' = None
+
+# Sound effects to synthesize when audio starts
+lazy_sounds: list['LazySound'] = []
+
+
+def start_music():
+    music.set_volume(MUSIC_VOLUME)
+    music.play('for_robots')
+
+
+async def init():
+    """Start up audio.
+
+    The music is opened on its own thread and synthesis of sound effects is
+    started in the background, so that the game can keep running while
+    this completes.
+    """
+    global voices
+    if mixer.get_init() != MIXER_SETTINGS:
+        mixer.quit()
+        mixer.init(*MIXER_SETTINGS)
+    voices = Voices()
+    opening = music_pool.submit(start_music)
+    for snd in lazy_sounds:
+        snd.start()
+
+    while not opening.done():
+        await w2d.clock.coro.next_frame()
+    opening.result()
+
+
+def say(sound_name):
+    """Play a sound from the sounds directory, if audio is running."""
+    if voices:
+        w2d.sounds.load(sound_name).play()
 
 
-laser = Sound(buffer=pyfxr.SFX(
+class LazySound:
+    """A synthesized sound that is generated in the background.
+
+    Sound objects are created on the main thread, the first time the sound
+    is played after its buffer is ready. Until then, playing it does nothing.
+    """
+
+    def __init__(self, volume=1.0, max_voices=4, priority=1, **params):
+        self.volume = volume
+        self.max_voices = max_voices
+        self.priority = priority
+        self.params = params
+        self.future = None
+        self._sound = None
+        lazy_sounds.append(self)
+
+    def start(self):
+        """Begin synthesizing the sound."""
+        if self.future is None:
+            self.future = synth_pool.submit(synthesize, self.params)
+
+    @property
+    def sound(self) -> 'Sound | None':
+        if self._sound is None and self.future and self.future.done():
+            self._sound = Sound(buffer=self.future.result())
+            self._sound.set_volume(min(self.volume / VOICE_VOLUME, 1.0))
+        return self._sound
+
+    def play(self):
+        if voices:
+            voices.play(self)
+
+    def stop(self):
+        if self._sound:
+            self._sound.stop()
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self._sound:
+            self._sound.set_volume(min(volume / VOICE_VOLUME, 1.0))
+
+    def get_length(self) -> float:
+        snd = self.sound
+        return snd.get_length() if snd else 0.0
+
+
+laser = LazySound(
+    volume=0.1,
+    max_voices=3,
+    priority=2,
     base_freq=0.61,
     freq_limit=0.224,
     freq_ramp=-0.304,
@@ -27,10 +246,12 @@ laser = Sound(buffer=pyfxr.SFX(
     pha_offset=0.01,
     pha_ramp=-0.132,
     wave_type=pyfxr.WaveType.SQUARE,
-))
-laser.set_volume(0.1)
+)
 
-enemy_laser = Sound(buffer=pyfxr.SFX(
+enemy_laser = LazySound(
+    volume=0.1,
+    max_voices=3,
+    priority=0,
     base_freq=0.46,
     freq_limit=0.2,
     freq_ramp=-0.187,
@@ -41,10 +262,12 @@ enemy_laser = Sound(buffer=pyfxr.SFX(
     env_decay=0.145,
     env_punch=0.043,
     wave_type=pyfxr.WaveType.SQUARE,
-))
-enemy_laser.set_volume(0.1)
+)
 
-explosion = Sound(buffer=pyfxr.SFX(
+explosion = LazySound(
+    volume=0.4,
+    max_voices=3,
+    priority=3,
     base_freq=0.06,
     freq_ramp=-0.011,
     env_attack=0.16,
@@ -55,10 +278,12 @@ explosion = Sound(buffer=pyfxr.SFX(
     lpf_freq=0.31,
     lpf_ramp=-0.15,
     wave_type=pyfxr.WaveType.NOISE,
-))
-explosion.set_volume(0.4)
+)
 
-explosion_small = Sound(buffer=pyfxr.SFX(
+explosion_small = LazySound(
+    volume=0.2,
+    max_voices=3,
+    priority=2,
     base_freq=0.06,
     freq_limit=0.0,
     freq_ramp=0.0,
@@ -72,10 +297,12 @@ explosion_small = Sound(buffer=pyfxr.SFX(
     arp_speed=0.72,
     arp_mod=0.404,
     wave_type=pyfxr.WaveType.NOISE,
-))
-explosion_small.set_volume(0.2)
+)
 
-powerup = Sound(buffer=pyfxr.SFX(
+powerup = LazySound(
+    volume=0.3,
+    max_voices=1,
+    priority=3,
     base_freq=0.241,
     freq_ramp=0.16,
     vib_strength=0.33,
@@ -87,10 +314,11 @@ powerup = Sound(buffer=pyfxr.SFX(
     arp_speed=0.28,
     arp_mod=0.0,
     wave_type=pyfxr.WaveType.SQUARE,
-))
-powerup.set_volume(0.3)
+)
 
-rocket = Sound(buffer=pyfxr.SFX(
+rocket = LazySound(
+    volume=0.15,
+    max_voices=3,
     base_freq=0.25,
     freq_limit=0.07,
     freq_ramp=0.16,
@@ -102,10 +330,12 @@ rocket = Sound(buffer=pyfxr.SFX(
     env_decay=0.51,
     env_punch=0.15,
     wave_type=pyfxr.WaveType.NOISE,
-))
-rocket.set_volume(0.15)
+)
 
-phaser = Sound(buffer=pyfxr.SFX(
+phaser = LazySound(
+    volume=0.2,
+    max_voices=2,
+    priority=2,
     base_freq=0.31,
     freq_limit=0.19,
     freq_ramp=-0.19,
@@ -116,11 +346,13 @@ phaser = Sound(buffer=pyfxr.SFX(
     env_decay=0.16,
     hpf_freq=0.189,
     wave_type=pyfxr.WaveType.SINE,
-))
-phaser.set_volume(0.2)
+)
 
 
-pause = Sound(buffer=pyfxr.SFX(
+pause = LazySound(
+    volume=0.3,
+    max_voices=1,
+    priority=4,
     base_freq=0.5,
     env_attack=0.0,
     env_sustain=0.29,
@@ -128,11 +360,13 @@ pause = Sound(buffer=pyfxr.SFX(
     env_punch=0.473,
     arp_speed=0.58,
     arp_mod=-0.18,
-))
-pause.set_volume(0.3)
+)
 
 impacts = [
-    Sound(buffer=pyfxr.SFX(
+    LazySound(
+        volume=0.3,
+        max_voices=2,
+        priority=0,
         base_freq=0.44 + i * 0.03,
         freq_ramp=-0.652,
         env_attack=0.0,
@@ -140,36 +374,32 @@ impacts = [
         env_decay=0.131,
         hpf_freq=0.197,
         wave_type=pyfxr.WaveType.NOISE,
-    ))
+    )
     for i in range(3)
 ]
-[i.set_volume(0.3) for i in impacts]
 def impact():
     random.choice(impacts).play()
 
-@lru_cache
-def placement(n):
-    freq = 0.29 + n * 0.01
-    s = Sound(buffer=pyfxr.SFX(
-        base_freq=freq,
+# Connector runs rise in pitch with each step, up to this many steps
+PLACEMENT_STEPS = 24
+
+placements = [
+    LazySound(
+        volume=0.05,
+        max_voices=2,
+        base_freq=0.29 + n * 0.01,
         freq_ramp=-0.489,
         env_attack=0.0,
         env_sustain=0.019,
         env_decay=0.234,
         wave_type=pyfxr.WaveType.SAW,
-    ))
-    s.set_volume(0.05)
-    return s
+    )
+    for n in range(PLACEMENT_STEPS)
+]
 
 
-async def play(sound_name):
-    snd = w2d.sounds.load(sound_name)
-    snd.play()
-    try:
-        await w2d.clock.coro.sleep(snd.get_length())
-    except:
-        snd.stop()
-        raise
+def placement(n):
+    return placements[min(n, PLACEMENT_STEPS - 1)]
 
 
 number_names = {
@@ -217,16 +447,102 @@ def spell(n):
         if tens:
             yield 'and'
             yield from spell(tens)
+    else:
+        for size, name in ((1_000_000, 'million'), (1000, 'thousand')):
+            if n >= size:
+                break
+        big, n = divmod(n, size)
+        yield from spell(big)
+        yield name
+        if n:
+            if n < 100:
+                yield 'and'
+            yield from spell(n)
 
 
-def pickup():
-    snd = Sound(buffer=pyfxr.SFX(
-        base_freq=random.uniform(0.75, 0.9),
+SOUNDS_DIR = Path(__file__).parent / 'sounds'
+
+# How many waves ahead to prepare announcements
+ANNOUNCE_AHEAD = 2
+
+
+class Announcer:
+    """Speak wave announcements.
+
+    The clips for the words of an announcement are joined into a single
+    buffer in the background, and kept until the wave has been announced.
+    """
+
+    def __init__(self):
+        self.paths = {
+            p.stem.lower(): p for p in SOUNDS_DIR.glob('*.wav')
+        }
+        self.words = {}  # word -> sample data
+        self.pending = {}  # wave number -> future of sample data
+
+    def _load_word(self, word) -> bytes:
+        data = self.words.get(word)
+        if data is None:
+            with wave.open(str(self.paths[word]), 'rb') as w:
+                if (w.getnchannels(), w.getsampwidth(), w.getframerate()) \
+                        != (1, 2, 44100):
+                    raise ValueError(f"{word}.wav is not 16-bit mono 44.1kHz")
+                data = self.words[word] = w.readframes(w.getnframes())
+        return data
+
+    def _assemble(self, words) -> bytes:
+        return b''.join(self._load_word(w) for w in words)
+
+    def prepare(self, wave_num):
+        """Start assembling the announcement for a wave."""
+        if wave_num not in self.pending:
+            self.pending[wave_num] = synth_pool.submit(
+                self._assemble,
+                ['beginning_wave', *spell(wave_num)],
+            )
+
+    async def announce(self, wave_num):
+        """Speak the announcement for a wave."""
+        if not voices:
+            return
+        for n in range(wave_num, wave_num + ANNOUNCE_AHEAD + 1):
+            self.prepare(n)
+        for n in [n for n in self.pending if n < wave_num]:
+            del self.pending[n]
+
+        future = self.pending.pop(wave_num)
+        while not future.done():
+            await w2d.clock.coro.next_frame()
+        snd = Sound(buffer=future.result())
+        snd.play()
+        try:
+            await w2d.clock.coro.sleep(snd.get_length())
+        except:
+            snd.stop()
+            raise
+
+
+announcer = Announcer()
+
+
+# Star bit pickups play one of this many pitches, chosen at random
+PICKUP_PITCHES = 8
+
+pickups = [
+    LazySound(
+        volume=0.2,
+        max_voices=2,
+        priority=2,
+        base_freq=0.75 + 0.15 * i / (PICKUP_PITCHES - 1),
         env_attack=0.0,
         env_sustain=0.039,
         env_decay=0.272,
         env_punch=0.468,
         arp_mod=0.253,
-    ))
-    snd.set_volume(0.2)
-    snd.play()
+    )
+    for i in range(PICKUP_PITCHES)
+]
+
+
+def pickup():
+    random.choice(pickups).play()
@@ -0,0 +1,151 @@
+"""Save and restore the state of a game between waves.
+
+A snapshot is a small binary file: a header, fixed-size records for the
+base layout, and the states of the random number generators.
+Restoring one places the base instantly, so a late wave can be replayed
+without playing all the waves before it.
+"""
+import random
+import struct
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+import building
+from building import Connection, Edge, Layout
+
+MAGIC = b'AXSN'
+VERSION = 2
+
+# magic, version, wave, lives, balance, then the number of each record
+HEADER = struct.Struct('<4sHIIqIIII')
+BUILDING = struct.Struct('<Biif')  # type, cell x, cell y, health
+LINK = struct.Struct('<II')  # building indexes
+WIRE = struct.Struct('<iiB')  # x, y, edge
+CONNECTOR = struct.Struct('<iiI')  # x, y, number of buildings
+# random: version, Mersenne Twister state, has gauss_next, gauss_next
+PY_RNG = struct.Struct('<I625I?d')
+# numpy.random: Mersenne Twister key, position, has_gauss, cached_gaussian
+NP_RNG = struct.Struct('<624Iiid')
+
+# Building types, in the order of their codes in a snapshot
+BUILDING_TYPES = (
+    building.Reactor,
+    building.Rockets,
+    building.PhaserBay,
+    building.RepairBay,
+)
+
+
+class Snapshot(NamedTuple):
+    wave: int
+    lives: int
+    balance: int
+    layout: Layout
+    rng_state: tuple  # (random state, numpy random state)
+
+    def dumps(self) -> bytes:
+        layout = self.layout
+        parts = [
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                self.wave,
+                self.lives,
+                self.balance,
+                len(layout.buildings),
+                len(layout.links),
+                len(layout.wiring),
+                len(layout.connectors),
+            )
+        ]
+        parts += [
+            BUILDING.pack(BUILDING_TYPES.index(cls), x, y, health)
+            for cls, (x, y), health in layout.buildings
+        ]
+        parts += [LINK.pack(i, j) for i, j in layout.links]
+        parts += [WIRE.pack(x, y, edge.value) for x, y, edge in layout.wiring]
+        parts += [
+            CONNECTOR.pack(x, y, n)
+            for (x, y), n in layout.connectors
+        ]
+        py_state, np_state = self.rng_state
+        version, mt, gauss = py_state
+        parts.append(PY_RNG.pack(
+            version, *mt, gauss is not None, gauss or 0.0
+        ))
+        _, key, pos, has_gauss, cached = np_state
+        parts.append(NP_RNG.pack(*key.tolist(), pos, has_gauss, cached))
+        return b''.join(parts)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'Snapshot':
+        (
+            magic, version, wave, lives, balance,
+            n_buildings, n_links, n_wiring, n_connectors
+        ) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not an Axium snapshot")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        offset = HEADER.size
+
+        def records(record, num):
+            nonlocal offset
+            end = offset + record.size * num
+            recs = list(record.iter_unpack(data[offset:end]))
+            offset = end
+            return recs
+
+        layout = Layout(
+            buildings=[
+                (BUILDING_TYPES[t], (x, y), health)
+                for t, x, y, health in records(BUILDING, n_buildings)
+            ],
+            links=records(LINK, n_links),
+            wiring=[
+                Connection(x, y, Edge(edge))
+                for x, y, edge in records(WIRE, n_wiring)
+            ],
+            connectors=[
+                ((x, y), n)
+                for x, y, n in records(CONNECTOR, n_connectors)
+            ],
+        )
+        version, *mt, has_gauss, gauss = PY_RNG.unpack_from(data, offset)
+        py_state = (version, tuple(mt), gauss if has_gauss else None)
+        *key, pos, has_gauss, cached = NP_RNG.unpack_from(
+            data, offset + PY_RNG.size
+        )
+        np_state = (
+            'MT19937', np.array(key, dtype=np.uint32), pos, has_gauss, cached
+        )
+        rng_state = (py_state, np_state)
+        return cls(wave, lives, balance, layout, rng_state)
+
+
+def take(wave: int, lives: int, balance: int) -> Snapshot:
+    """Take a snapshot of the game, to resume at the start of wave."""
+    return Snapshot(
+        wave=wave,
+        lives=lives,
+        balance=balance,
+        layout=building.base.layout(),
+        rng_state=(random.getstate(), np.random.get_state()),
+    )
+
+
+def restore_rng(snapshot: Snapshot):
+    """Put the random number generators back as they were."""
+    py_state, np_state = snapshot.rng_state
+    random.setstate(py_state)
+    np.random.set_state(np_state)
+
+
+def save(path, snapshot: Snapshot):
+    Path(path).write_bytes(snapshot.dumps())
+
+
+def load(path) -> Snapshot:
+    return Snapshot.loads(Path(path).read_bytes())
@@ -0,0 +1,119 @@
+"""Keyframe animations evaluated as a function of clock time.
+
+Unlike animate(), which creates a tween for every change, a timeline's
+tracks are pure functions of the time since it started playing. All playing
+timelines are updated together, once per frame, and values that have not
+changed since the last frame are not written back, so a light that is
+holding steady costs nothing.
+"""
+import heapq
+from bisect import bisect_right
+from contextlib import contextmanager
+from itertools import count
+from math import inf
+
+import wasabi2d as w2d
+from wasabi2d.animation import TWEEN_FUNCTIONS, tween_attr
+
+import clocks
+from clocks import coro
+
+
+class Track:
+    """Keyframes for one value.
+
+    keyframes is a list of (time, value) pairs in order of time. Between
+    keyframes the value is tweened; outside them it holds. A looping track
+    repeats with a period of its last keyframe time.
+    """
+
+    def __init__(self, keyframes, *, tween='linear', loop=False):
+        self.times = [t for t, _ in keyframes]
+        self.values = [v for _, v in keyframes]
+        self.tween = TWEEN_FUNCTIONS[tween]
+        self.loop = loop
+        self.duration = inf if loop else self.times[-1]
+
+    def __call__(self, t):
+        """Get the value at time t."""
+        if self.loop:
+            t %= self.times[-1]
+        i = bisect_right(self.times, t)
+        if i == 0:
+            return self.values[0]
+        if i == len(self.times):
+            return self.values[-1]
+        t0 = self.times[i - 1]
+        n = self.tween((t - t0) / (self.times[i] - t0))
+        return tween_attr(n, self.values[i - 1], self.values[i])
+
+
+class Timeline:
+    """Tracks that animate attributes of objects from a common start time."""
+
+    def __init__(self, tracks):
+        self.tracks = [[obj, attr, track, None] for obj, attr, track in tracks]
+        self.duration = max(track.duration for _, _, track in tracks)
+        self.start = None
+        self.marks = []
+        self.seq = count()
+        self.finished = self.at(self.duration)
+
+    def at(self, t) -> w2d.Event:
+        """Get an event that is set when the timeline reaches time t."""
+        event = w2d.Event()
+        heapq.heappush(self.marks, (t, next(self.seq), event))
+        return event
+
+    def update(self, t) -> bool:
+        """Apply the timeline at clock time t.
+
+        Return True if the timeline has finished.
+        """
+        elapsed = t - self.start
+        for entry in self.tracks:
+            obj, attr, track, last = entry
+            v = track(elapsed)
+            if v != last:
+                setattr(obj, attr, v)
+                entry[3] = v
+        marks = self.marks
+        while marks and marks[0][0] <= elapsed:
+            heapq.heappop(marks)[2].set()
+        return elapsed >= self.duration
+
+
+class Timelines:
+    """All playing timelines."""
+
+    def __init__(self):
+        self.active = set()
+
+    @contextmanager
+    def playing(self, timeline: Timeline):
+        """Play the timeline from now until it finishes or the context exits."""
+        timeline.start = clocks.game.t
+        self.active.add(timeline)
+        try:
+            yield timeline
+        finally:
+            self.active.discard(timeline)
+
+    def update(self, t):
+        finished = [tl for tl in self.active if tl.update(t)]
+        self.active.difference_update(finished)
+
+
+timelines = Timelines()
+
+
+async def play(timeline: Timeline):
+    """Play a timeline until it finishes; looping timelines play forever."""
+    with timelines.playing(timeline):
+        await timeline.finished
+
+
+async def run_timelines():
+    """Update all playing timelines, every frame."""
+    async for _ in coro.frames():
+        timelines.update(clocks.game.t)